@@ -1,29 +1,29 @@
 import os
-import sys
 import random
 import cv2
+import click
 import imutils
 import filetype
 import numpy as np
 from datetime import datetime
-import matplotlib.pyplot as plt
-from PIL import Image, ImageEnhance
 
+from utils import lazy, profiling
 
-def help() -> None:
-    """
-    Displays usage of this program
-    """
-    print("help:\n\tAugmentation.py [path_to_img]")
+
+# Name of each augmentation, as suffixed to the augmented image files
+AUGMENTATIONS = ['Flip', 'Rotate', 'Contrast', 'Brightness', 'Shear',
+                 'Projection']
 
 
-def plot_images(img, f, r, c, b, s, p):
+def plot_images(img, augmented):
     """
-    Displays every transformed image along with the original in a plot
+    Displays every augmented image along with the original in a plot
     Arguments:
         img (np.ndarray): array representing the original image
-        f, r, c, b, s, p (np.ndarray): arrays representing the augmented images
+        augmented (dict): array representing each augmented image, by
+            augmentation name
     """
+    plt = lazy.pyplot()
     plt.figure(figsize=(8, 6))
 
     # Plot original image
@@ -31,34 +31,11 @@ def plot_images(img, f, r, c, b, s, p):
     plt.imshow(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
     plt.title('Original')
 
-    # Plot flipped image
-    plt.subplot(3, 3, 2)
-    plt.imshow(cv2.cvtColor(f, cv2.COLOR_BGR2RGB))
-    plt.title("Flip")
-
-    # Plot rotated image
-    plt.subplot(3, 3, 3)
-    plt.imshow(cv2.cvtColor(r, cv2.COLOR_BGR2RGB))
-    plt.title("Rotation")
-
-    # Plot rotated image
-    plt.subplot(3, 3, 4)
-    plt.imshow(c)
-    plt.title("Contrast")
-
-    # Plot rotated image
-    plt.subplot(3, 3, 5)
-    plt.imshow(b)
-    plt.title("Brightness")
-
-    # Plot rotated image
-    plt.subplot(3, 3, 6)
-    plt.imshow(cv2.cvtColor(s, cv2.COLOR_BGR2RGB))
-    plt.title("Shear")
-    # Plot rotated image
-    plt.subplot(3, 3, 7)
-    plt.imshow(cv2.cvtColor(p, cv2.COLOR_BGR2RGB))
-    plt.title("Projection")
+    # Plot augmented images
+    for i, (name, augmented_img) in enumerate(augmented.items()):
+        plt.subplot(3, 3, i + 2)
+        plt.imshow(cv2.cvtColor(augmented_img, cv2.COLOR_BGR2RGB))
+        plt.title(name)
 
     # set the spacing between subplots
     plt.subplots_adjust(left=0.1,
@@ -72,170 +49,235 @@ def plot_images(img, f, r, c, b, s, p):
     plt.show()
 
 
-def flip(img_path, img):
+def flip(img, rng=random):
     """
     Flips the image along vertical axis
     Arguments:
-        img_path (str): path to the image
         img (np.ndarray): array representing the image
+        rng (random.Random, default: random): unused, for a common signature
     Returns:
         An array representing the flipped image
     """
-    flipped_img = cv2.flip(img, 1)
-    cv2.imwrite(img_path[0:len(img_path) - 4]+"_Flip.JPG", flipped_img)
-
-    return flipped_img
+    return cv2.flip(img, 1)
 
 
-def rotate(img_path, img):
+def rotate(img, rng=random):
     """
     Rotates the image randomly
     Arguments:
-        img_path (str): path to the image
         img (np.ndarray): array representing the image
+        rng (random.Random, default: random): random generator
     Returns:
         An array representing the rotated image
     """
-    rotated_img = imutils.rotate_bound(img, random.choice([-30, -20, -10,
-                                                           10, 20, 30]))
-    cv2.imwrite(img_path[0:len(img_path) - 4]+"_Rotate.JPG", rotated_img)
-    return rotated_img
+    return imutils.rotate_bound(img, rng.choice([-30, -20, -10,
+                                                 10, 20, 30]))
 
 
-def contrast(img_path, img):
+def apply_lut(img, lut):
     """
-    Adjusts the image's contrast
+    Maps every channel value of an image through a lookup table
     Arguments:
-        img_path (str): path to the image
-        img (np.ndarray): array representing the image
+        img (np.ndarray): uint8 array representing the image
+        lut (np.ndarray): 256 float values, clipped and truncated to uint8
+            as PIL's ImageEnhance does
     Returns:
-        An array representing the image with adjusted contrast
+        An array representing the mapped image
     """
-    # Open the image
-    image = Image.open(img_path)
+    return np.take(np.clip(lut, 0, 255).astype(np.uint8), img)
 
-    # Create an enhancer object for brightness
-    enhancer = ImageEnhance.Contrast(image)
 
+def contrast(img, rng=random):
+    """
+    Adjusts the image's contrast, as PIL's ImageEnhance.Contrast does:
+    values are pushed away from the mean grey level of the image
+    Arguments:
+        img (np.ndarray): array representing the image
+        rng (random.Random, default: random): unused, for a common signature
+    Returns:
+        An array representing the image with adjusted contrast
+    """
     contrast_factor = 1.5
-    # Adjust the brightness
-    enhanced_image = enhancer.enhance(contrast_factor)
+    # PIL's integer RGB to L conversion, on BGR channels
+    blue, green, red = (img[..., i].astype(np.uint32) for i in range(3))
+    grey = (red * 19595 + green * 38470 + blue * 7471 + 0x8000) >> 16
+    mean = int(grey.mean() + 0.5)
+    values = np.arange(256, dtype=np.float64)
+    return apply_lut(img, mean + contrast_factor * (values - mean))
 
-    # Save the modified image
-    enhanced_image.save(img_path[0:len(img_path) - 4]+"_Contrast.JPG")
 
-    return enhanced_image
-
-
-def brightness(img_path, img):
+def brightness(img, rng=random):
     """
-    Adjusts the image's brightness
+    Adjusts the image's brightness, as PIL's ImageEnhance.Brightness does
     Arguments:
-        img_path (str): path to the image
         img (np.ndarray): array representing the image
+        rng (random.Random, default: random): unused, for a common signature
     Returns:
         An array representing the image with adjusted brightness
     """
-    # Open the image
-    image = Image.open(img_path)
+    # PIL blends with black in float32, float64 rounds some values up
+    brightness_factor = np.float32(1.3)
+    return apply_lut(img, brightness_factor * np.arange(256,
+                                                        dtype=np.float32))
 
-    # Create an enhancer object for brightness
-    enhancer = ImageEnhance.Brightness(image)
 
-    brightness_factor = 1.3
-    # Adjust the brightness
-    enhanced_image = enhancer.enhance(brightness_factor)
-
-    # Save the modified image
-    enhanced_image.save(img_path[0:len(img_path) - 4]+"_Contrast.JPG")
-
-    return enhanced_image
-
-
-def shear(img_path, img):
+def shear(img, rng=random):
     """
     Applies a random shear mapping to the image
     Arguments:
-        img_path (str): path to the image
         img (np.ndarray): array representing the image
+        rng (random.Random, default: random): random generator
     Returns:
         An array representing the transformed image
     """
     num_rows, num_cols = img.shape[:2]
     src_points = np.float32([[0, 0], [num_cols-1, 0], [0, num_rows-1]])
     dst_points = np.float32([[0, 0],
-                             [int(random.choice([0.7, 0.6, 0.5])
+                             [int(rng.choice([0.7, 0.6, 0.5])
                                   * (num_cols-1)), 0],
-                             [int(random.choice([0.6, 0.5])
+                             [int(rng.choice([0.6, 0.5])
                                   * (num_cols-1)), num_rows-1]])
     matrix = cv2.getAffineTransform(src_points, dst_points)
-    img_shear = cv2.warpAffine(img, matrix, (num_cols, num_rows))
-    cv2.imwrite(img_path[0:len(img_path) - 4] + "_Shear.JPG", img_shear)
-
-    return img_shear
+    return cv2.warpAffine(img, matrix, (num_cols, num_rows))
 
 
-def projection(img_path, img):
+def projection(img, rng=random):
     """
     Projects the image randomly
     Arguments:
-        img_path (str): path to the image
         img (np.ndarray): array representing the image
+        rng (random.Random, default: random): random generator
     Returns:
         An array representing the projected image
     """
     num_rows, num_cols = img.shape[:2]
     src_points = np.float32([[0, 0], [num_cols-1, 0], [0, num_rows-1],
                              [num_cols-1, num_rows-1]])
-    dst_points = np.float32([[int(random.choice([0, 0.1, 0.2, 0.3])
+    dst_points = np.float32([[int(rng.choice([0, 0.1, 0.2, 0.3])
                                   * num_cols), 0],
-                             [int(random.choice([1.0, 0.9, 0.8, 0.7])
+                             [int(rng.choice([1.0, 0.9, 0.8, 0.7])
                                   * num_cols)-1, 0],
-                             [int(random.choice([0, 0.1, 0.2, 0.3])
+                             [int(rng.choice([0, 0.1, 0.2, 0.3])
                                   * num_cols), num_rows-1],
-                             [int(random.choice([1.0, 0.9, 0.8, 0.7])
+                             [int(rng.choice([1.0, 0.9, 0.8, 0.7])
                                   * num_cols), num_rows-1]])
     projective_matrix = cv2.getPerspectiveTransform(src_points, dst_points)
-    img_projection = cv2.warpPerspective(img, projective_matrix,
-                                         (num_cols, num_rows))
-    cv2.imwrite(img_path[0:len(img_path) - 4] + "_Projection.JPG",
-                img_projection)
-
-    return img_projection
+    return cv2.warpPerspective(img, projective_matrix, (num_cols, num_rows))
 
 
-def augment(img_path: str, plot=True) -> None:
+def augment_array(img, rng=random) -> dict:
     """
-    Applies each previous augmentation to an image
+    Applies each previous augmentation to a decoded image, in memory
     Arguments:
-        img_path (str): path to the image
-        plot (boolean, default: True): plotting of the resulting images
+        img (np.ndarray): BGR array representing the image
+        rng (random.Random, default: random): random generator
+    Returns:
+        A dict mapping each name of AUGMENTATIONS to its augmented array
     """
-    img = cv2.imread(img_path)
+    operations = [flip, rotate, contrast, brightness, shear, projection]
+    augmented = {}
+    for name, operation in zip(AUGMENTATIONS, operations):
+        with profiling.stage(name):
+            augmented[name] = operation(img, rng)
+    return augmented
 
-    f = flip(img_path, img)
-    r = rotate(img_path, img)
-    c = contrast(img_path, img)
-    b = brightness(img_path, img)
-    s = shear(img_path, img)
-    p = projection(img_path, img)
 
-    if plot:
-        plot_images(img, f, r, c, b, s, p)
+def augment_random(img, rng=random):
+    """
+    Applies one augmentation picked at random, or none, as a class balanced
+    by GenerateAugmentedDirectory.py holds each original along with its
+    augmentations. Used to augment training batches in memory
+    Arguments:
+        img (np.ndarray): BGR array representing the image
+        rng (random.Random, default: random): random generator
+    Returns:
+        An array of the same shape as img
+    """
+    operation = rng.choice([None, flip, rotate, contrast, brightness, shear,
+                            projection])
+    if operation is None:
+        return img
+    augmented = operation(img, rng)
+    if augmented.shape != img.shape:
+        # rotate_bound grows the image, resize it as decoding would
+        augmented = cv2.resize(augmented, (img.shape[1], img.shape[0]),
+                               interpolation=cv2.INTER_LINEAR)
+    return augmented
+
+
+def save_augmentations(img_path: str, augmented: dict) -> list:
+    """
+    Writes augmented images next to their original
+    Arguments:
+        img_path (str): path to the original image
+        augmented (dict): augmented arrays, by augmentation name
+    Returns:
+        A list of the paths of the images written
+    """
+    paths = []
+    for name, augmented_img in augmented.items():
+        paths.append(img_path[0:len(img_path) - 4] + f"_{name}.JPG")
+        with profiling.stage('encode'):
+            cv2.imwrite(paths[-1], augmented_img)
+    return paths
 
 
-def main() -> None:
+def augment(img_path: str, plot=True, save=True, rng=random,
+            img=None) -> dict:
+    """
+    Applies each previous augmentation to an image, decoding it only once
+    Arguments:
+        img_path (str): path to the image
+        plot (boolean, default: True): plotting of the resulting images
+        save (boolean, default: True): writing of the resulting images
+        rng (random.Random, default: random): random generator
+        img (np.ndarray, default: None): the image already decoded, read
+            from img_path when None
+    Returns:
+        A dict mapping each augmentation name to its augmented array
+    """
+    with profiling.stage('augment'):
+        if img is None:
+            with profiling.stage('decode'):
+                img = cv2.imread(img_path)
+        augmented = augment_array(img, rng)
+        if save:
+            save_augmentations(img_path, augmented)
+    profiling.count('images')
+    if plot:
+        plot_images(img, augmented)
+    return augmented
+
+
+@click.command()
+@click.option('--headless', is_flag=True,
+              help="Don't plot anything, implied when no display is"
+                   + " available or LEAFFLICTION_HEADLESS=1")
+@click.option('--profile', default=None,
+              help="Write a Chrome trace of the run's stages to this file"
+                   + " and print their timings")
+@click.argument('file')
+def main(file, headless, profile) -> None:
+    """
+    Saves every augmentation of the jpeg image FILE next to it and
+    displays them
+    """
+    if profile is not None:
+        profiling.enable()
     # set random seed
     random.seed(datetime.now().timestamp())
-    # argument
-    if len(sys.argv) != 2:
-        return help()
-    if os.path.isfile(sys.argv[1]) is False:
-        return print("Argument {} does not exist".format(sys.argv[1]))
-    if (filetype.guess(sys.argv[1]) is None
-       or filetype.guess(sys.argv[1]).extension != 'jpg'):
-        return print("Argument {} is not a jpeg img".format(sys.argv[1]))
-    augment(sys.argv[1])
+    if os.path.isfile(file) is False:
+        return print("Argument {} does not exist".format(file))
+    if (filetype.guess(file) is None
+       or filetype.guess(file).extension != 'jpg'):
+        return print("Argument {} is not a jpeg img".format(file))
+    # Decoded here once, for both the augmentations and the plot
+    with profiling.stage('decode'):
+        img = cv2.imread(file)
+    augmented = augment(file, plot=False, img=img)
+    profiling.finish(profile)
+    if not (headless or lazy.headless()):
+        plot_images(img, augmented)
 
 
 if __name__ == "__main__":
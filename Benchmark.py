@@ -0,0 +1,524 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import click
+import numpy as np
+
+
+# Registered benchmarks, as (name, group, factory) tuples. A factory takes
+# the benchmark context and returns the function to time
+BENCHMARKS = []
+GROUPS = ['transform', 'augment', 'directory', 'train', 'predict',
+          'startup']
+# Command line entry points started from a cold interpreter, with the
+# arguments they run with and their startup budget in milliseconds. Scripts
+# importing TensorFlow at module level get a larger one
+ENTRY_POINTS = {
+    'Augmentation.py': (['--help'], 500),
+    'Transformation.py': (['--help'], 500),
+    'Predict.py': (['--help'], 500),
+    'GenerateAugmentedDirectory.py': (['--help'], 500),
+    'BuildTensorStore.py': (['--help'], 500),
+    'Serve.py': (['--help'], 500),
+    'Distribution.py': ([], 300),
+    'Train.py': (['--help'], 6000),
+    'evaluate_models.py': (['--help'], 6000),
+    'Export.py': (['--help'], 6000),
+}
+
+
+def benchmark(name, group):
+    """
+    Registers a benchmark factory under a name and a group
+    """
+    def register(factory):
+        BENCHMARKS.append((name, group, factory))
+        return factory
+    return register
+
+
+def synthetic_leaf(rng, size=256):
+    """
+    Draws a leaf-like BGR image: a green leaf with veins and brown spots on
+    a light, noisy background, so that benchmarks need no dataset
+    Arguments:
+        rng (np.random.Generator): random generator
+        size (int, default: 256): height and width of the image
+    Returns:
+        A (size, size, 3) uint8 np.ndarray
+    """
+    import cv2
+    img = np.full((size, size, 3), 200, dtype=np.uint8)
+    img = cv2.add(img, rng.integers(0, 40, img.shape, dtype=np.uint8))
+    center = (size // 2 + int(rng.integers(-size // 16, size // 16)),
+              size // 2 + int(rng.integers(-size // 16, size // 16)))
+    axes = (int(size * rng.uniform(0.3, 0.4)),
+            int(size * rng.uniform(0.18, 0.28)))
+    angle = float(rng.uniform(0, 180))
+    green = (int(rng.integers(20, 60)), int(rng.integers(120, 170)),
+             int(rng.integers(30, 70)))
+    cv2.ellipse(img, center, axes, angle, 0, 360, green, -1)
+    # Midrib and veins
+    rad = np.deg2rad(angle)
+    direction = np.array([np.cos(rad), np.sin(rad)])
+    tip = (np.array(center) + direction * axes[0]).astype(int)
+    base = (np.array(center) - direction * axes[0]).astype(int)
+    cv2.line(img, tuple(map(int, base)), tuple(map(int, tip)),
+             (80, 190, 110), max(1, size // 128))
+    normal = np.array([-direction[1], direction[0]])
+    for t in np.linspace(-0.6, 0.6, 6):
+        start = np.array(center) + direction * axes[0] * t
+        for side in (-1, 1):
+            end = (start + normal * side * axes[1] * 0.8
+                   + direction * axes[0] * 0.2)
+            cv2.line(img, tuple(map(int, start)), tuple(map(int, end)),
+                     (70, 175, 100), 1)
+    # Disease spots
+    for _ in range(int(rng.integers(0, 12))):
+        offset = rng.normal(0, 0.3, 2) * axes
+        spot = (int(center[0] + offset[0]), int(center[1] + offset[1]))
+        cv2.circle(img, spot, int(rng.integers(2, size // 24 + 3)),
+                   (30, 60, 110), -1)
+    return cv2.GaussianBlur(img, (3, 3), 0)
+
+
+def make_dataset(root, classes=2, per_class=16, size=256, seed=0):
+    """
+    Writes a synthetic dataset laid out like the real ones
+    Arguments:
+        root (str): dataset directory, created if need be
+        classes (int, default: 2): number of class sub-directories
+        per_class (int, default: 16): number of images of each class
+        size (int, default: 256): height and width of the images
+        seed (int, default: 0): seed of the images
+    Returns:
+        The list of paths of the images written
+    """
+    import cv2
+    rng = np.random.default_rng(seed)
+    fruit = os.path.basename(root.rstrip('/'))
+    paths = []
+    for label in range(classes):
+        directory = os.path.join(root, f'{fruit}_class{label}')
+        os.makedirs(directory, exist_ok=True)
+        for i in range(per_class):
+            paths.append(os.path.join(directory, f'image ({i + 1}).JPG'))
+            cv2.imwrite(paths[-1], synthetic_leaf(rng, size))
+    return paths
+
+
+def measure(function, repeat, warmup=1):
+    """
+    Times a function
+    Arguments:
+        function (callable): function called without arguments
+        repeat (int): number of timed calls
+        warmup (int, default: 1): number of untimed calls made first
+    Returns:
+        A dict of the mean, median, min and max durations in milliseconds
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': float(np.mean(times)),
+            'median_ms': float(np.median(times)),
+            'min_ms': float(np.min(times)), 'max_ms': float(np.max(times)),
+            'repeat': repeat}
+
+
+def _transform(name):
+    def factory(context):
+        import Transformation
+        function = getattr(Transformation, name)
+        return lambda: function(context['img'])
+    return factory
+
+
+for _name in ['mask_image', 'transform_gaussian_blur', 'transform_masked',
+              'transform_roi', 'transform_analysis',
+              'transform_pseudolandmarks', 'transform_colors']:
+    benchmark(_name, 'transform')(_transform(_name))
+
+
+@benchmark('mask_image_opencv', 'transform')
+def _mask_image_opencv(context):
+    from Transformation import mask_image
+    return lambda: mask_image(context['img'], backend='opencv')
+
+
+@benchmark('mask_image_opencv_buffers', 'transform')
+def _mask_image_opencv_buffers(context):
+    from Transformation import mask_image_opencv, MaskBuffers
+    buffers = MaskBuffers(context['img'].shape)
+    return lambda: mask_image_opencv(context['img'], buffers)
+
+
+@benchmark('transform_all', 'transform')
+def _transform_all(context):
+    from Transformation import transform_all, ALL_TYPES
+    return lambda: transform_all(context['img'], ALL_TYPES)
+
+
+@benchmark('transform_all_working_128', 'transform')
+def _transform_all_working(context):
+    from Transformation import transform_all, to_working_size, ALL_TYPES
+    img = to_working_size(context['img'], 128)
+    return lambda: transform_all(img, ALL_TYPES, 128)
+
+
+def _read_image(working_size):
+    def factory(context):
+        from Transformation import read_image
+        return lambda: read_image(context['paths'][0], working_size)
+    return factory
+
+
+benchmark('read_image', 'transform')(_read_image(None))
+benchmark('read_image_working_128', 'transform')(_read_image(128))
+
+
+@benchmark('augment_array', 'augment')
+def _augment_array(context):
+    import random
+    from Augmentation import augment_array
+    rng = random.Random(0)
+    return lambda: augment_array(context['img'], rng)
+
+
+@benchmark('augment', 'augment')
+def _augment(context):
+    import random
+    from Augmentation import augment
+    rng = random.Random(0)
+    path = context['paths'][0]
+    return lambda: augment(path, plot=False, rng=rng)
+
+
+def _directory(workers):
+    def factory(context):
+        from Transformation import transform_directory
+        dst = os.path.join(context['tmp'], f'transformed_{workers}')
+
+        def run():
+            shutil.rmtree(dst, ignore_errors=True)
+            transform_directory(context['dataset'], dst, 'all', workers,
+                                separate=True, incremental=False)
+        return run
+    return factory
+
+
+benchmark('transform_directory', 'directory')(_directory(1))
+benchmark('transform_directory_parallel', 'directory')(
+    _directory(os.cpu_count() or 1))
+
+
+def _model(context):
+    """
+    Builds, once per run, an untrained model of the training script
+    """
+    if 'model' not in context:
+        from Train import make_model
+
+        class Classes:
+            class_names = ['class0', 'class1']
+        context['model'] = make_model(Classes())
+        context['model'].build((None, 128, 128, 3))
+    return context['model']
+
+
+def _batch(context, batch_size):
+    import cv2
+    img = cv2.resize(context['img'], (128, 128))
+    return np.repeat(img[np.newaxis], batch_size, axis=0)
+
+
+@benchmark('train_step', 'train')
+def _train_step(context):
+    model = _model(context)
+    images = _batch(context, 32)
+    labels = np.arange(32) % 2
+    return lambda: model.train_on_batch(images, labels)
+
+
+@benchmark('predict_batch_32', 'predict')
+def _predict_batch(context):
+    model = _model(context)
+    images = _batch(context, 32)
+    return lambda: model.predict_on_batch(images)
+
+
+@benchmark('predict_image', 'predict')
+def _predict_image(context):
+    from Predict import load_image
+    from Transformation import transform_all, ALL_TYPES
+    model = _model(context)
+
+    def run():
+        # One prediction per transformation, as Predict.py does
+        images = transform_all(context['img'], ALL_TYPES)
+        for name in ALL_TYPES:
+            model.predict_on_batch(load_image(images[name]))
+    return run
+
+
+def entry_point_command(script, args=None, importtime=False):
+    """
+    Builds the command starting an entry point, headless, from this
+    directory
+    Arguments:
+        script (str): name of the entry point script
+        args (list, default: None): its arguments, ENTRY_POINTS' when None
+        importtime (boolean, default: False): make python report the time
+            each import took on stderr
+    Returns:
+        The command as a list of arguments
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return ([sys.executable] + (['-X', 'importtime'] if importtime else [])
+            + [os.path.join(directory, script)]
+            + (ENTRY_POINTS[script][0] if args is None else args))
+
+
+def run_entry_point(command):
+    """
+    Runs a command to completion, headless and without output
+    Arguments:
+        command (list): command and its arguments
+    Returns:
+        The completed process, its stderr captured
+    """
+    env = dict(os.environ, LEAFFLICTION_HEADLESS='1')
+    return subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def _startup(script):
+    def factory(context):
+        command = entry_point_command(script)
+        return lambda: run_entry_point(command)
+    return factory
+
+
+for _script in ENTRY_POINTS:
+    benchmark(f'startup_{_script[:-3]}', 'startup')(_startup(_script))
+
+
+def slowest_imports(stderr, count):
+    """
+    Parses the report of python -X importtime
+    Arguments:
+        stderr (str): standard error of the process
+        count (int): number of imports kept
+    Returns:
+        A list of (module, cumulative ms) tuples of the slowest top level
+        imports, slowest first
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the one that triggered them
+        if not name[1:].startswith(' '):
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: -item[1])[:count]
+
+
+def git_commit():
+    """
+    Returns:
+        The commit the benchmarks ran on, or None outside of a git tree
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def main():
+    """
+    Offline benchmarks of the transformation, augmentation, training and
+    prediction hot paths, on synthetic leaf images
+    """
+
+
+@main.command()
+@click.option('--out', default='benchmark.json',
+              help="JSON file the results are written to")
+@click.option('--repeat', default=5, help="Timed calls of each benchmark")
+@click.option('--size', default=256,
+              help="Height and width of the synthetic images")
+@click.option('--images', default=16,
+              help="Synthetic images per class of the directory benchmarks")
+@click.option('--group', 'groups', multiple=True,
+              type=click.Choice(GROUPS),
+              help="Only run these groups, every group by default")
+@click.option('--only', multiple=True,
+              help="Only run these benchmarks")
+def run(out, repeat, size, images, groups, only):
+    """
+    Runs the benchmarks and saves their timings
+    """
+    tmp = tempfile.mkdtemp(prefix='leaffliction_bench_')
+    try:
+        dataset = os.path.join(tmp, 'Leaf')
+        context = {'tmp': tmp, 'dataset': dataset,
+                   'paths': make_dataset(dataset, per_class=images,
+                                         size=size)}
+        context['img'] = synthetic_leaf(np.random.default_rng(0), size)
+        results = {}
+        for name, group, factory in BENCHMARKS:
+            if (groups and group not in groups) or (only and
+                                                    name not in only):
+                continue
+            print(f"{name:<32}", end='', flush=True)
+            # Directory benchmarks are long, a single warm-up is plenty
+            function = factory(context)
+            results[name] = dict(measure(
+                function, 1 if group == 'directory' else repeat,
+                0 if group == 'directory' else 1), group=group)
+            print(f"{results[name]['mean_ms']:>12.2f} ms")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    report = {'meta': {'commit': git_commit(),
+                       'python': sys.version.split()[0],
+                       'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(),
+                       'size': size, 'images': images,
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': results}
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out}")
+
+
+@main.command('check-mask')
+@click.option('--images', default=64, help="Synthetic images compared")
+@click.option('--size', default=256,
+              help="Height and width of the synthetic images")
+@click.option('--seed', default=0, help="Seed of the synthetic images")
+def check_mask(images, size, seed):
+    """
+    Checks that every mask backend gives the same pixels as plantcv, and
+    exits with status 1 otherwise
+    """
+    from Transformation import (mask_image, mask_image_opencv, MaskBuffers,
+                                MASK_BACKENDS)
+    rng = np.random.default_rng(seed)
+    buffers = MaskBuffers((size, size, 3))
+    mismatches = 0
+    for i in range(images):
+        img = synthetic_leaf(rng, size)
+        if i % 2:
+            # Uniform noise reaches every saturation, threshold included
+            img = rng.integers(0, 256, img.shape, dtype=np.uint8)
+        expected = mask_image(img, backend='plantcv')
+        masks = {backend: mask_image(img, backend=backend)
+                 for backend in MASK_BACKENDS}
+        masks['opencv (buffers)'] = mask_image_opencv(img, buffers)
+        for backend, mask in masks.items():
+            if (mask.shape != expected.shape or mask.dtype != expected.dtype
+               or not np.array_equal(mask, expected)):
+                mismatches += 1
+                print(f"Image {i}: {backend} mask differs from plantcv")
+    if mismatches:
+        print(f"{mismatches} masks differ")
+        sys.exit(1)
+    print(f"Masks of {images} images identical for {', '.join(masks)}")
+
+
+@main.command()
+@click.option('--repeat', default=5, help="Cold starts of each entry point")
+@click.option('--only', multiple=True, type=click.Choice(list(ENTRY_POINTS)),
+              help="Only time these entry points")
+@click.option('--imports', default=0,
+              help="Also list this many of the slowest top level imports of"
+                   + " each entry point")
+@click.option('--scale', default=1.0,
+              help="Multiplier of the budgets, for slower machines")
+def startup(repeat, only, imports, scale):
+    """
+    Times the cold start of every command line entry point, up to the end
+    of its --help, and exits with status 1 if any exceeds its budget
+    """
+    baseline = measure(lambda: run_entry_point([sys.executable, '-c', '']),
+                       repeat)
+    print(f"{'entry point':<32}{'median (ms)':>12}{'budget (ms)':>13}")
+    print(f"{'python (empty)':<32}{baseline['median_ms']:>12.1f}")
+    over = []
+    for script, (args, budget) in ENTRY_POINTS.items():
+        if only and script not in only:
+            continue
+        command = entry_point_command(script)
+        if run_entry_point(command).returncode != 0:
+            over.append(script)
+            print(f"{script:<32}{'failed':>12}{budget * scale:>13.0f}")
+            continue
+        timing = measure(lambda: run_entry_point(command), repeat)
+        flag = ''
+        if timing['median_ms'] > budget * scale:
+            over.append(script)
+            flag = '  OVER BUDGET'
+        print(f"{script:<32}{timing['median_ms']:>12.1f}"
+              + f"{budget * scale:>13.0f}{flag}")
+        if imports:
+            process = run_entry_point(entry_point_command(script,
+                                                          importtime=True))
+            for name, cumulative in slowest_imports(process.stderr,
+                                                    imports):
+                print(f"    {name:<28}{cumulative:>12.1f}")
+    if over:
+        print(f"{len(over)} entry points failed or exceeded their budget")
+        sys.exit(1)
+    print("Every entry point started within its budget")
+
+
+@main.command()
+@click.option('--threshold', default=0.1,
+              help="Relative slowdown flagged as a regression")
+@click.argument('baseline')
+@click.argument('current')
+def compare(baseline, current, threshold):
+    """
+    Compares the results CURRENT against BASELINE and exits with status 1
+    if any benchmark got slower than the threshold allows
+    """
+    with open(baseline) as f:
+        old = json.load(f)['results']
+    with open(current) as f:
+        new = json.load(f)['results']
+    regressions = []
+    print(f"{'benchmark':<32}{'baseline (ms)':>15}{'current (ms)':>15}"
+          + f"{'change':>10}")
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name]['median_ms'], new[name]['median_ms']
+        change = after / before - 1 if before else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<32}{before:>15.2f}{after:>15.2f}{change:>+10.1%}"
+              + flag)
+    for name in sorted(set(old) ^ set(new)):
+        print(f"{name:<32} only in {'baseline' if name in old else 'current'}")
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {threshold:.0%}")
+        sys.exit(1)
+    print(f"No regression beyond {threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
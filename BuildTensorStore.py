@@ -0,0 +1,37 @@
+import os
+import time
+import click
+
+from Transformation import TYPE_SUFFIXES
+from utils import tensor_store
+
+
+@click.command()
+@click.option('--size', default=128,
+              help="Height and width of the stored images")
+@click.option('--validation-split', default=0.2,
+              help="Share of the source images kept for validation")
+@click.option('--shard-size', default=2048,
+              help="Number of images per shard file")
+@click.option('--workers', default=os.cpu_count() or 1,
+              help="Number of processes decoding the images")
+@click.argument('directory')
+def main(directory, size, validation_split, shard_size, workers):
+    """
+    Decodes the transformed dataset DIRECTORY once into memory-mapped
+    arrays, read by Train.py and evaluate_models.py with --store
+    """
+    if os.path.isdir(directory) is False:
+        return print("Argument {} is not a directory".format(directory))
+    start = time.perf_counter()
+    metadata = tensor_store.build_store(directory, TYPE_SUFFIXES, size,
+                                        validation_split, shard_size,
+                                        workers)
+    print(f"Stored {metadata['rows']} images of"
+          + f" {len(metadata['transformations'])} transformations in"
+          + f" {tensor_store.store_path(directory)}"
+          + f" ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,20 @@
 import os
 import sys
-import matplotlib.pyplot as plt
+import json
+import struct
+import contextlib
+import multiprocessing
 from typing import TypedDict
 
+from utils import dataset_index, lazy
+
+
+# Statistics cache persisted at the root of an analysed directory
+STATS_NAME = '.leaffliction_stats.json'
+STATS_VERSION = 1
+# Below this many files, a process pool costs more than it saves
+POOL_THRESHOLD = 256
+
 
 class CountDict(TypedDict):
     directory_name: str
@@ -23,26 +35,204 @@ def getCountDictionary(directory: str) -> CountDict:
     Arguments:
         directory (str): parent directory
     Returns:
-        A CountDict representing the number of images in each sub-directory
+        A CountDict representing the number of images in each sub-directory,
+        files lying directly in the parent directory being ignored
     """
+    stray_files = dataset_index.stray_files(directory)
+    if len(stray_files) > 0:
+        print(f"Ignoring {len(stray_files)} files outside of any"
+              + f" sub-directory, like {stray_files[0]}")
     count_dict: CountDict = CountDict()
-    for subdir in os.listdir(directory):
-        if os.path.isdir(os.path.join(directory, subdir)) is False:
-            return print(f"{os.path.join(directory, subdir)} not a directory")
-        count_dict[subdir] = len(os.listdir(os.path.join(directory, subdir)))
+    for subdir, count in dataset_index.class_counts(directory).items():
+        count_dict[subdir] = count
     return count_dict
 
 
+def jpeg_dimensions(path) -> tuple:
+    """
+    Reads the dimensions of a JPEG image from its frame header, without
+    decoding the image
+    Arguments:
+        path (str or file object): path to the image, or the image opened
+            in binary mode, e.g. an io.BytesIO of its bytes
+    Returns:
+        A (width, height) tuple, or None if the file isn't a readable JPEG
+    """
+    try:
+        with (open(path, 'rb') if isinstance(path, str)
+              else contextlib.nullcontext(path)) as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                byte = f.read(1)
+                while byte and byte != b'\xff':
+                    byte = f.read(1)
+                while byte == b'\xff':
+                    byte = f.read(1)
+                if not byte or byte[0] in (0xd9, 0xda):
+                    return None
+                marker = byte[0]
+                if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                    continue    # markers without a segment
+                length = struct.unpack('>H', f.read(2))[0]
+                # Start of frame markers, DHT, JPG and DAC excluded
+                if (0xc0 <= marker <= 0xcf
+                   and marker not in (0xc4, 0xc8, 0xcc)):
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+
+def _run_jobs(function, paths: list, workers: int) -> list:
+    """
+    Applies a function to every path, in a process pool if worth it
+    Returns:
+        The results, in the order of paths
+    """
+    if workers > 1 and len(paths) >= POOL_THRESHOLD:
+        with multiprocessing.Pool(workers) as pool:
+            return pool.map(function, paths, chunksize=64)
+    return list(map(function, paths))
+
+
+def load_statistics_cache(directory: str) -> dict:
+    """
+    Loads the statistics cache of a directory
+    Returns:
+        The cache, an empty one if it's missing, unreadable or outdated
+    """
+    empty = {'version': STATS_VERSION, 'fingerprint': None, 'files': {}}
+    try:
+        with open(os.path.join(directory, STATS_NAME)) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    return cache if cache.get('version') == STATS_VERSION else empty
+
+
+def save_statistics_cache(directory: str, cache: dict) -> None:
+    """
+    Atomically writes the statistics cache of a directory. Read-only
+    directories simply aren't cached
+    """
+    cache_path = os.path.join(directory, STATS_NAME)
+    try:
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError:
+        pass
+
+
+def getStatistics(directory: str, workers: int = None) -> dict:
+    """
+    Computes the file count, byte size, image dimensions and duplicate
+    count of each sub-directory. Dimensions come from JPEG headers and
+    only files of equal sizes are hashed to find duplicates. Results are
+    cached in the directory and reused as long as no file's size or mtime
+    changed. The directory is listed again on every call, so that long
+    lived callers like the GUI see files added or removed since
+    Arguments:
+        directory (str): parent directory
+        workers (int, default: None): processes reading the files, one per
+            core when None
+    Returns:
+        A dict mapping each sub-directory to its 'count', 'bytes',
+        'dimensions' ({'WxH': count}) and 'duplicates', i.e. files whose
+        content was already seen elsewhere in the directory
+    """
+    workers = workers or os.cpu_count() or 1
+    index = dataset_index.load_index(directory, refresh=True)
+    fingerprint = dataset_index.fingerprint(directory)
+    cache = load_statistics_cache(directory)
+    if cache['fingerprint'] == fingerprint and 'statistics' in cache:
+        return cache['statistics']
+
+    # [size, mtime_ns, width, height, sha1] of each file inside a class
+    files = {}
+    for rel, (size, mtime_ns, _) in index['files'].items():
+        if len(rel.split(os.sep)) != 2:
+            continue
+        old = cache['files'].get(rel)
+        if old is not None and old[:2] == [size, mtime_ns]:
+            files[rel] = old
+        else:
+            files[rel] = [size, mtime_ns, None, None, None]
+
+    unread = sorted(rel for rel, record in files.items()
+                    if record[2] is None)
+    for rel, dimensions in zip(unread, _run_jobs(
+            jpeg_dimensions, [os.path.join(directory, rel)
+                              for rel in unread], workers)):
+        files[rel][2:4] = dimensions or [0, 0]
+
+    by_size = {}
+    for rel, record in files.items():
+        by_size.setdefault(record[0], []).append(rel)
+    candidates = sorted(rel for rels in by_size.values() if len(rels) > 1
+                        for rel in rels if files[rel][4] is None)
+    for rel, digest in zip(candidates, _run_jobs(
+            dataset_index.file_digest,
+            [os.path.join(directory, rel) for rel in candidates], workers)):
+        files[rel][4] = digest
+
+    statistics = {name: {'count': 0, 'bytes': 0, 'dimensions': {},
+                         'duplicates': 0}
+                  for name in dataset_index.classes(directory)}
+    seen = set()
+    for rel in sorted(files):
+        size, _, width, height, digest = files[rel]
+        stats = statistics[rel.split(os.sep, 1)[0]]
+        stats['count'] += 1
+        stats['bytes'] += size
+        key = f'{width}x{height}' if width else 'unknown'
+        stats['dimensions'][key] = stats['dimensions'].get(key, 0) + 1
+        if len(by_size[size]) > 1:
+            if (size, digest) in seen:
+                stats['duplicates'] += 1
+            seen.add((size, digest))
+
+    save_statistics_cache(directory, {'version': STATS_VERSION,
+                                      'fingerprint': fingerprint,
+                                      'files': files,
+                                      'statistics': statistics})
+    return statistics
+
+
+def printStatistics(statistics: dict) -> None:
+    """
+    Prints the statistics of each sub-directory as a table
+    Arguments:
+        statistics (dict): result of getStatistics
+    """
+    print(f"{'class':<24}{'images':>8}{'MB':>10}{'duplicates':>12}"
+          + "  dimensions")
+    for name, stats in statistics.items():
+        dimensions = ', '.join(f'{key} ({count})' for key, count
+                               in sorted(stats['dimensions'].items(),
+                                         key=lambda item: -item[1]))
+        print(f"{name:<24}{stats['count']:>8}"
+              + f"{stats['bytes'] / 1e6:>10.1f}{stats['duplicates']:>12}"
+              + f"  {dimensions}")
+
+
 def getNameValue(leaf: str):
     """
-    Gets the image count of each sub-directory and plots them all
+    Gets the statistics of each sub-directory, prints them and plots the
+    image counts, unless running headless
     Arguments:
         leaf (str): parent directory
     """
-    count_dict = getCountDictionary(leaf)
-    names = list(count_dict.keys())
-    values = list(count_dict.values())
-    plt.bar(range(len(count_dict)),
+    statistics = getStatistics(leaf)
+    printStatistics(statistics)
+    if lazy.headless():
+        return
+    plt = lazy.pyplot()
+    names = list(statistics.keys())
+    values = [stats['count'] for stats in statistics.values()]
+    plt.bar(range(len(statistics)),
             values,
             tick_label=names,
             color=['blue', 'orange', 'green', 'red'])
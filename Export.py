@@ -0,0 +1,154 @@
+import os
+import time
+
+import click
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.utils import image_dataset_from_directory
+
+from utils import ensemble
+from utils.fused import save_fused_model
+
+
+def load_split(directory, subset, limit=None):
+    """
+    Loads one split of a transformation's dataset, as Train.py splits it
+    Arguments:
+        directory (str): directory of the transformed images of one
+            transformation
+        subset (str): 'training' or 'validation'
+        limit (int, default: None): only decode this many images of the
+            shuffled split, all of them when None
+    Returns:
+        A (images, labels) tuple of np.ndarray
+    """
+    data = image_dataset_from_directory(
+        directory,
+        validation_split=0.2,
+        subset=subset,
+        shuffle=True,
+        seed=42,
+        image_size=(128, 128),
+    )
+    if limit is not None:
+        # Files are shuffled before decoding, the others are never read
+        data = data.unbatch().take(limit).batch(32)
+    batches = list(data.as_numpy_iterator())
+    return (np.concatenate([x for x, _ in batches]),
+            np.concatenate([y for _, y in batches]))
+
+
+def export_member(model, quantize, representative=None):
+    """
+    Converts a keras model to TFLite
+    Arguments:
+        model (keras.Model): trained model
+        quantize (str): 'none', 'float16' or 'int8'
+        representative (np.ndarray, default: None): training images used to
+            calibrate int8 quantization
+    Returns:
+        The serialized TFLite model
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        # Weights and activations in int8, float32 inputs and outputs
+        def representative_dataset():
+            for img in representative:
+                yield [img[np.newaxis].astype(np.float32)]
+        converter.representative_dataset = representative_dataset
+    return converter.convert()
+
+
+def time_predictions(model, images, batch_size):
+    """
+    Predicts images batch by batch and measures the mean latency per batch
+    Returns:
+        A (predictions, seconds per batch) tuple
+    """
+    predictions = []
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        predictions.append(np.asarray(
+            model.predict_on_batch(images[i:i + batch_size])))
+    elapsed = time.perf_counter() - start
+    batches = max(1, (len(images) + batch_size - 1) // batch_size)
+    return np.concatenate(predictions), elapsed / batches
+
+
+def compare(path, directory, names, batch_size):
+    """
+    Prints the accuracy and latency of the keras and tflite backends of
+    every model on its validation split
+    Arguments:
+        path (str): directory of the ensemble
+        directory (str): transformed dataset the ensemble was trained on
+        names (list): transformations to compare
+        batch_size (int): number of images predicted at once
+    """
+    print(f"{'model':<17}{'backend':<9}{'accuracy':>10}"
+          + f"{f'ms/batch({batch_size})':>16}")
+    for name in names:
+        images, labels = load_split(os.path.join(directory, name),
+                                    'validation')
+        for backend in ensemble.BACKENDS:
+            model = ensemble.load_member(path, name, backend)
+            # Warm up, first calls build the graph or allocate tensors
+            model.predict_on_batch(images[:batch_size])
+            predictions, latency = time_predictions(model, images,
+                                                    batch_size)
+            accuracy = np.mean(np.argmax(predictions, axis=1) == labels)
+            print(f"{name:<17}{backend:<9}{accuracy:>10.4f}"
+                  + f"{latency * 1000:>16.2f}")
+
+
+@click.command()
+@click.option('--format', 'export_format', default='tflite',
+              type=click.Choice(['tflite', 'fused']),
+              help="Export each model to TFLite, or fuse every model and"
+                   + " both votes into a single multi-input keras model")
+@click.option('--quantize', default='none',
+              type=click.Choice(['none', 'float16', 'int8']),
+              help="Quantization applied to the TFLite models")
+@click.option('--compare', 'compare_backends', is_flag=True,
+              help="Compare accuracy and latency against the keras models"
+                   + " on the validation split")
+@click.option('--batch-size', default=32,
+              help="Batch size used by the comparison")
+@click.argument('directory')
+def main(directory, export_format, quantize, compare_backends, batch_size):
+    """
+    Exports the ensemble trained on DIRECTORY: its models to TFLite, so
+    that Predict.py and evaluate_models.py can run with --backend tflite,
+    or all of them to one fused model for Predict.py --fused
+    """
+    directory = directory.rstrip('/')
+    path = ensemble.artifact_path(directory)
+    if not os.path.isdir(path):
+        return print(f"{path} not found, train {directory} first")
+    if export_format == 'fused':
+        save_fused_model(path)
+        return print(f"Fused model saved in {path}")
+    names = ensemble.load_metadata(path)['transformations']
+    for name in names:
+        print(f"Exporting {name} model ({quantize})")
+        representative = None
+        if quantize == 'int8':
+            representative = load_split(os.path.join(directory, name),
+                                        'training', limit=200)[0]
+        tflite_model = export_member(ensemble.load_member(path, name),
+                                     quantize, representative)
+        with open(os.path.join(path, ensemble.member_file(name, 'tflite')),
+                  'wb') as f:
+            f.write(tflite_model)
+    ensemble.write_metadata(path, tflite={'quantization': quantize})
+    if compare_backends:
+        compare(path, directory, names, batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,99 @@
 import os
-import sys
 import random
-from datetime import datetime
-
-from Augmentation import augment
-from Distribution import getCountDictionary
+import multiprocessing
 
+import click
 
-def help() -> None:
-    print("help:\n\tGenerateAugmentedDirectory.py [directory]")
+from Augmentation import augment, AUGMENTATIONS
+from Distribution import getCountDictionary
+from utils import dataset_index, profiling
 
 
-def main():
-    random.seed(datetime.now().timestamp())
-    if len(sys.argv) != 2:
-        return help()
-    if os.path.isdir(sys.argv[1]) is False:
-        return print("Argument {} is not a directory".format(sys.argv[1]))
-    # delete max from dict
-    count_dict = getCountDictionary(sys.argv[1])
+def plan_augmentations(directory: str, seed: int) -> dict:
+    """
+    Picks up front, without replacement, the images of each class to
+    augment so that every class reaches the size of the largest one
+    Arguments:
+        directory (str): dataset holding one sub-directory per class
+        seed (int): seed of the picks and of each image's augmentations
+    Returns:
+        A dict mapping each class to its list of (image path, seed) jobs
+    """
+    rng = random.Random(seed)
+    count_dict = getCountDictionary(directory)
     max_key = max(count_dict, key=lambda key: count_dict[key])
     max_count = count_dict[max_key]
     count_dict.pop(max_key)
-    # augmentation each subdirectory
-    for key in count_dict:
-        print('Augmenting', key)
-        augment_number = int((max_count - count_dict[key]) / 7)
-        images = os.listdir(os.path.join(sys.argv[1], key))
-        for i in range(augment_number):
-            print(f'\rAugmented {i+1}/{augment_number} images', end='')
-            cur_img = random.choice(images)
-            augment(os.path.join(sys.argv[1], key, cur_img), plot=False)
-            images.remove(cur_img)
-        print()
-        print()
+    plan = {}
+    for key in sorted(count_dict):
+        # The original and each augmentation make one image each
+        augment_number = int((max_count - count_dict[key])
+                             / (len(AUGMENTATIONS) + 1))
+        images = dataset_index.images(directory, key)
+        picked = rng.sample(images, min(augment_number, len(images)))
+        # One seed per image keeps results independent of the workers
+        plan[key] = [(path, rng.getrandbits(64)) for path in picked]
+    return plan
+
+
+def _augment_job(job: tuple) -> str:
+    """
+    Augments one image with its own random generator, in a worker process
+    if need be
+    Arguments:
+        job (tuple): (image path, seed) pair
+    Returns:
+        The path to the augmented image
+    """
+    img_path, seed = job
+    augment(img_path, plot=False, rng=random.Random(seed))
+    return img_path
+
+
+@click.command()
+@click.option('--seed', default=None, type=int,
+              help="Seed of the augmentations, random when omitted")
+@click.option('--workers', default=os.cpu_count() or 1,
+              help="Number of processes augmenting images")
+@click.option('--profile', default=None,
+              help="Write a Chrome trace of the run's stages to this file"
+                   + " and print their timings")
+@click.argument('directory')
+def main(directory, seed, workers, profile):
+    """
+    Balances the classes of DIRECTORY by augmenting images of the smaller
+    ones. A given seed gives the same images whatever the number of workers
+    """
+    if os.path.isdir(directory) is False:
+        return print("Argument {} is not a directory".format(directory))
+    if profile is not None:
+        profiling.enable()
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    print(f"Augmenting with seed {seed}")
+    with profiling.stage('plan'):
+        plan = plan_augmentations(directory, seed)
+    job = profiling.wrap(_augment_job)
+    pool = None
+    if workers > 1 and sum(len(jobs) for jobs in plan.values()) > 1:
+        pool = multiprocessing.Pool(workers)
+    try:
+        # augmentation each subdirectory
+        for key, jobs in plan.items():
+            print('Augmenting', key)
+            results = (pool.imap_unordered(job, jobs, chunksize=4)
+                       if pool is not None else map(job, jobs))
+            for i, _ in enumerate(profiling.merge(results), start=1):
+                print(f'\rAugmented {i}/{len(jobs)} images', end='',
+                      flush=True)
+            print()
+            print()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     print('All subdirectories augmented')
+    profiling.finish(profile)
 
 
 if __name__ == "__main__":
@@ -1,58 +1,50 @@
 import os
-import sys
+import csv
+import cv2
+import glob
+import click
 import filetype
 import numpy as np
 
-import matplotlib.pyplot as plt
-import joblib
+from Transformation import (transform_all, read_image, set_mask_backend,
+                            ALL_TYPES, MASK_BACKENDS)
+from utils import dataset_index, ensemble, lazy, profiling, voting
 
-from plantcv import plantcv as pcv
-
-from keras.preprocessing import image
-from PIL import Image
-
-from Transformation import transform_gaussian_blur, transform_masked
-from Transformation import transform_roi, transform_analysis
-from Transformation import transform_pseudolandmarks, find
-
-
-def help():
-    print("usage: python3 Predict.py [image_path]")
-
-
-def plot_images(path, fruit, class_pred):
-    # Open the images
-    image = Image.open(path)
-    b = Image.open(f"{fruit}_BLURRED.JPG")
-    m = Image.open(f"{fruit}_MASKED.JPG")
-    p = Image.open(f"{fruit}_PSEUDOLANDMARKS.JPG")
-    r = Image.open(f"{fruit}_ROI_OBJECTS.JPG")
-    a = Image.open(f"{fruit}_ANALYZED.JPG")
 
+def plot_images(img, images, class_pred):
+    """
+    Displays the original image and its transformations along with the
+    predicted class
+    Arguments:
+        img (np.ndarray): BGR array of the original image
+        images (dict): BGR arrays of the transformations, by type
+        class_pred (str): the predicted class
+    """
+    plt = lazy.pyplot()
     plt.figure(figsize=(8, 6))
 
     plt.subplot(3, 2, 1)
-    plt.imshow(image)
+    plt.imshow(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
     plt.title('Original')
 
     plt.subplot(3, 2, 2)
-    plt.imshow(b)
+    plt.imshow(cv2.cvtColor(images['blur'], cv2.COLOR_BGR2RGB))
     plt.title('Gaussian Blur')
 
     plt.subplot(3, 2, 3)
-    plt.imshow(m)
+    plt.imshow(cv2.cvtColor(images['mask'], cv2.COLOR_BGR2RGB))
     plt.title('Mask')
 
     plt.subplot(3, 2, 4)
-    plt.imshow(p)
+    plt.imshow(cv2.cvtColor(images['pseudolandmarks'], cv2.COLOR_BGR2RGB))
     plt.title('Pseudolandmark')
 
     plt.subplot(3, 2, 5)
-    plt.imshow(r)
+    plt.imshow(cv2.cvtColor(images['roi'], cv2.COLOR_BGR2RGB))
     plt.title('ROI objects')
 
     plt.subplot(3, 2, 6)
-    plt.imshow(a)
+    plt.imshow(cv2.cvtColor(images['analysis'], cv2.COLOR_BGR2RGB))
     plt.title('Analysis')
 
     # set the spacing between subplots
@@ -77,66 +69,35 @@ def plot_images(path, fruit, class_pred):
     plt.show()
 
 
-def make_images(path, fruit):
+def make_images(path, working_size=None):
     """
-    Creates transformations of the original image for the predictions
+    Creates transformations of the original image for the predictions,
+    keeping them in memory
     Arguments:
         path (str): path to the original image
-        fruit (str): the type of fruit we're working with
-    """
-    pcv.params.debug_outdir = "."
-    img, path, filename = pcv.readimage(path)
-
-    img_b = transform_gaussian_blur(img)
-    pcv.print_image(img_b, f"{fruit}_BLURRED.JPG")
-    img_p = transform_pseudolandmarks(img)
-    pcv.print_image(img_p, f"{fruit}_PSEUDOLANDMARKS.JPG")
-    img_m = transform_masked(img)
-    pcv.print_image(img_m, f"{fruit}_MASKED.JPG")
-    img_roi = transform_roi(img)
-    pcv.print_image(img_roi, f"{fruit}_ROI_OBJECTS.JPG")
-    img_a = transform_analysis(img)
-    pcv.print_image(img_a, f"{fruit}_ANALYZED.JPG")
-
-
-def remove_images(fruit):
-    """
-    Removes the no longer necessary image files created during processing
-    Arguments:
-        fruit (str): the type of fruit we're working with
+        working_size (int, default: None): side of the square images the
+            models' training images were transformed at, full resolution
+            when None
+    Returns:
+        A (original image, transformations by type) tuple of BGR arrays
     """
-    os.remove(f'./{fruit}_BLURRED.JPG')
-    os.remove(f'./{fruit}_PSEUDOLANDMARKS.JPG')
-    os.remove(f'./{fruit}_MASKED.JPG')
-    os.remove(f'./{fruit}_ROI_OBJECTS.JPG')
-    os.remove(f'./{fruit}_ANALYZED.JPG')
+    with profiling.stage('decode'):
+        img = read_image(path, working_size)
+    return img, transform_all(img, ALL_TYPES, working_size)
 
 
-def load_image(type, fruit):
+def load_image(img):
     """
-    Loads the specified transformed image of a fruit into a tensor array
+    Converts a transformed image into the tensor array the models expect
     Arguments:
-        type (str): type of transformation to be loaded
-        fruit (str): the type of fruit we're working with
+        img (np.ndarray): BGR array of the transformed image
     Returns
         A np.ndarray containing the transformed image's data
     """
-    path = None
-
-    if type == 'blur':
-        path = f'./{fruit}_BLURRED.JPG'
-    if type == 'pseudolandmarks':
-        path = f'./{fruit}_PSEUDOLANDMARKS.JPG'
-    if type == 'mask':
-        path = f'./{fruit}_MASKED.JPG'
-    if type == 'roi':
-        path = f'./{fruit}_ROI_OBJECTS.JPG'
-    if type == 'analysis':
-        path = f'./{fruit}_ANALYZED.JPG'
-
-    img = image.load_img(path, target_size=(128, 128))
+    # Bilinear resizing, as image_dataset_from_directory does for training
+    img = cv2.resize(img, (128, 128), interpolation=cv2.INTER_LINEAR)
     # (height, width, channels)
-    img_tensor = image.img_to_array(img)
+    img_tensor = cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32)
     # (1, height, width, channels), need to add a dimension because the model
     # expects this shape: (batch_size, height, width, channels)
     img_tensor = np.expand_dims(img_tensor, axis=0)
@@ -144,6 +105,7 @@ def load_image(type, fruit):
     return img_tensor
 
 def print_image_summary(images, cols=8):
+    plt = lazy.pyplot()
     for i in range(len(images)):
         channels = images[i].shape[-1]
         images_ = images[i][0]
@@ -157,81 +119,282 @@ def print_image_summary(images, cols=8):
         plt.subplots_adjust(wspace=0, hspace=0)
     plt.show()
 
-def soft_vote(predictions):
+def fruit_directory(image_path):
     """
-    Computes the average prediction for each sample and class (soft vote)
+    Gives the directory of the fruit an image belongs to, its images being
+    stored in one sub-directory per class
     Arguments:
-        predictions (np.ndarray): the predictions array
+        image_path (str): path to the image
+    Returns:
+        The path of the fruit's directory
     """
-    ensemble_prediction = np.mean(predictions, axis=0)
+    return (os.path.dirname(os.path.dirname(image_path))
+            or os.path.dirname(os.path.dirname(os.path.abspath(image_path))))
 
-    # Convert ensemble predictions to class labels
-    # (index of the maximum probability)
-    max_index = np.argmax(ensemble_prediction)
 
-    print(f'soft vote prediction percentage: {ensemble_prediction[max_index]}')
-
-    return max_index
-
-
-def hard_vote(preds):
+def find_artifact(fruit, suffix):
+    """
+    Finds the models Train.py saved for a fruit, next to the transformed
+    dataset they were trained on: 'transformed/Apple' gives
+    'transformed/Apple.model'. They are looked for next to the fruit's
+    directory, then in the directories of the current one, and only then
+    in the whole tree
+    Arguments:
+        fruit (str): directory of the fruit's images, e.g. 'Apple'
+        suffix (str): ensemble.ARTIFACT_SUFFIX, or '.joblib' for ensembles
+            trained before it
+    Returns:
+        The path of the models, or None if none was found
     """
-    Computes the majority vote for each sample and class (hard vote)
+    fruit = os.path.normpath(fruit)
+    name = os.path.basename(fruit) + suffix
+    patterns = [glob.escape(fruit) + suffix, os.path.join('*', name),
+                os.path.join('**', name)]
+    if not os.path.isabs(fruit):
+        patterns.insert(1, os.path.join('*', glob.escape(fruit) + suffix))
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if matches:
+            return matches[0]
+    return None
+
+
+def load_ensemble(fruit, backend='keras', fused=False):
+    """
+    Gives access to the trained models of a fruit along with the
+    transformation each of them was trained on. Models of an ensemble
+    artifact are only loaded when first used, joblib ensembles trained
+    before it are still supported
     Arguments:
-        preds (np.ndarray): the predictions array
+        fruit (str): directory of the fruit's images, e.g. 'Apple'
+        backend (str, default: 'keras'): 'keras', or 'tflite' for exported
+            ensemble artifacts
+        fused (boolean, default: False): load the single fused model of an
+            exported ensemble artifact instead of its members
+    Returns:
+        A (models, transformations, classes, working size) tuple, classes
+        being None for joblib ensembles and the working size None for full
+        resolution, or None if no model was trained. models is the fused
+        keras.Model itself when fused is requested
     """
-    nb_classes = len(preds[0])
+    path = find_artifact(fruit, ensemble.ARTIFACT_SUFFIX)
+    if path is not None:
+        metadata = ensemble.load_metadata(path)
+        if fused and 'fused' not in metadata:
+            return None
+        if fused:
+            from utils.fused import load_fused_model
+            models = load_fused_model(path)
+        else:
+            models = ensemble.load_members(path, metadata['transformations'],
+                                           backend)
+        return (models, metadata['transformations'], metadata['classes'],
+                metadata.get('working_size'))
+    path = find_artifact(fruit, '.joblib')
+    if path is None or backend != 'keras' or fused:
+        return None
+    import joblib
+    models = joblib.load(filename=path)
+    # Saved next to the transformed dataset it was trained on
+    transformations = dataset_index.classes(path[:-len('.joblib')])
+    return models, transformations, None, None
 
-    pred_array = [pred for i in range(len(preds)) for pred in preds[i]]
 
-    print(f'hard vote pred. percentage : {pred_array[np.argmax(pred_array)]}')
+def run_ensemble(models, transformations, inputs, fused=False):
+    """
+    Predicts a batch of images with every model and votes
+    Arguments:
+        models (list or keras.Model): models, in transformation order, or
+            the fused model
+        transformations (list): transformation of each model
+        inputs (list): (batch_size, 128, 128, 3) array of each
+            transformation
+        fused (boolean, default: False): models is the fused model, whose
+            single call already votes
+    Returns:
+        A (probabilities, soft votes, hard votes, hard vote probabilities)
+        tuple of np.ndarray
+    """
+    profiling.count('images', len(inputs[0]))
+    if fused:
+        with profiling.stage('inference'):
+            outputs = models.predict(dict(zip(transformations, inputs)),
+                                     verbose=0)
+        return (outputs['probabilities'], outputs['soft_vote'],
+                outputs['hard_vote'], outputs['hard_confidence'])
+    with profiling.stage('inference'):
+        predictions = [model.predict(batch, verbose=0)
+                       for model, batch in zip(models, inputs)]
+    with profiling.stage('vote'):
+        return (voting.soft_probabilities(predictions),
+                voting.soft_vote(predictions), voting.hard_vote(predictions),
+                voting.hard_confidence(predictions))
+
+
+def prepare_image(path, transformations, working_size=None):
+    """
+    Computes the transformations of an image in memory and converts them to
+    the models' input
+    Arguments:
+        path (str): path to the original image
+        transformations (list): transformations to compute, in model order
+        working_size (int, default: None): side of the square images the
+            transformations are computed at, full resolution when None
+    Returns:
+        A list of (128, 128, 3) RGB float arrays, one per transformation
+    """
+    with profiling.stage('prepare_image'):
+        with profiling.stage('decode'):
+            img = read_image(path, working_size)
+        outputs = transform_all(img, transformations, working_size)
+        with profiling.stage('resize'):
+            return [load_image(outputs[t])[0] for t in transformations]
 
-    return np.argmax(pred_array) % nb_classes
 
-def main():
-    # argument
-    if len(sys.argv) != 2:
-        return help()
-    if os.path.isfile(sys.argv[1]) is False:
-        return print("Argument {} is not a file".format(sys.argv[1]))
-    if (filetype.guess(sys.argv[1]) is None
-       or filetype.guess(sys.argv[1]).extension != 'jpg'):
-        return print(f"{sys.argv[1]} is not a jpeg image")
+def list_targets(target):
+    """
+    Lists the jpeg images designated by a directory or a glob pattern
+    Arguments:
+        target (str): directory or glob pattern
+    Returns:
+        A sorted list of paths to jpeg images
+    """
+    if os.path.isdir(target):
+        return dataset_index.images(target)
+    return sorted(path for path in glob.glob(target, recursive=True)
+                  if os.path.isfile(path) and filetype.guess(path) is not None
+                  and filetype.guess(path).extension == 'jpg')
 
-    jl_name = sys.argv[1].split("/", 1)[0] + '.joblib'
-    path = find(jl_name, ".")
-    if path is None:
-        return print(f'{jl_name} model not trained')
-    models = joblib.load(filename=path)
 
-    fruit = sys.argv[1].split("/", 1)[0]
-    make_images(sys.argv[1], fruit)
-
-    predictions = []
-    transformations = sorted(os.listdir(os.path.dirname(path)+f'/{fruit}'))
-    for i in range(len(models)):
-        if False and transformations[i]=="blur":
-            image_ = load_image(transformations[i], fruit)
-            conv2d_image = image_
-            images = []
-            for layer in models[i].layers[:3]:
-                conv2d_image = layer(conv2d_image)
-                images.append(conv2d_image)
-            print_image_summary(images, cols=3)
-        prediction = models[i].predict(load_image(transformations[i], fruit))
-        predictions.append(prediction[0])
-
-    s_vote = soft_vote(predictions)
-    h_vote = hard_vote(predictions)
-    classes = sorted(os.listdir(os.path.dirname(os.path.dirname(sys.argv[1]))))
+def predict_batch(target, out, batch_size, backend='keras', fused=False):
+    """
+    Predicts the class of every image of a directory or glob pattern, loading
+    the models once and calling each of them on large batches
+    Arguments:
+        target (str): directory or glob pattern of the images
+        out (str): path of the resulting csv file
+        batch_size (int): number of images transformed and predicted at once
+        backend (str, default: 'keras'): backend running the models
+        fused (boolean, default: False): run the fused model
+    """
+    with profiling.stage('list_targets'):
+        paths = list_targets(target)
+    if len(paths) == 0:
+        return print(f"{target} does not match any jpeg image")
+    # The fruit's directory, whether target is it, a class of it or a glob
+    fruit = fruit_directory(paths[0])
+    with profiling.stage('load_models'):
+        trained = load_ensemble(fruit, backend, fused)
+    if trained is None:
+        return print(f'{os.path.basename(os.path.normpath(fruit))} model not'
+                     + f' trained for the {backend} backend')
+    models, transformations, classes, working_size = trained
+    if classes is None:
+        classes = dataset_index.classes(fruit)
+
+    with open(out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'soft_vote', 'hard_vote']
+                        + [f'p_{name}' for name in classes])
+        for start in range(0, len(paths), batch_size):
+            chunk = paths[start:start + batch_size]
+            inputs = [prepare_image(path, transformations, working_size)
+                      for path in chunk]
+            probabilities, s_votes, h_votes, _ = run_ensemble(
+                models, transformations,
+                [np.stack([images[i] for images in inputs])
+                 for i in range(len(transformations))],
+                fused)
+            for j, path in enumerate(chunk):
+                writer.writerow([path, classes[s_votes[j]],
+                                 classes[h_votes[j]]]
+                                + [f'{p:.6f}' for p in probabilities[j]])
+            print(f"\rPredicted {start + len(chunk)}/{len(paths)} images",
+                  end='', flush=True)
+    print(f"\nPredictions written to {out}")
+
+
+def predict_image(path, backend='keras', fused=False, profile=None,
+                  headless=False):
+    """
+    Predicts the class of a single image and displays its transformations
+    Arguments:
+        path (str): path to the image
+        backend (str, default: 'keras'): backend running the models
+        fused (boolean, default: False): run the fused model
+        profile (str, default: None): trace file of a profiled run, written
+            before the plot is displayed
+        headless (boolean, default: False): skip the plot
+    """
+    if (filetype.guess(path) is None
+       or filetype.guess(path).extension != 'jpg'):
+        return print(f"{path} is not a jpeg image")
+
+    fruit = fruit_directory(path)
+    with profiling.stage('load_models'):
+        trained = load_ensemble(fruit, backend, fused)
+    if trained is None:
+        return print(f'{os.path.basename(os.path.normpath(fruit))} model not'
+                     + f' trained for the {backend} backend')
+    models, transformations, classes, working_size = trained
+
+    img, images = make_images(path, working_size)
+
+    with profiling.stage('resize'):
+        inputs = [load_image(images[t]) for t in transformations]
+    probabilities, s_votes, h_votes, confidences = run_ensemble(
+        models, transformations, inputs, fused)
+    s_vote, h_vote = int(s_votes[0]), int(h_votes[0])
+    print('soft vote prediction percentage:'
+          + f' {probabilities[0][s_vote]}')
+    print(f'hard vote pred. percentage : {confidences[0]}')
+    if classes is None:
+        classes = dataset_index.classes(
+            os.path.dirname(os.path.dirname(path)))
     print(f'soft voting predicted : {classes[s_vote]}')
     print(f'hard voting predicted : {classes[h_vote]}')
+    profiling.finish(profile)
 
-    plot_images(sys.argv[1],
-                fruit,
+    if headless or lazy.headless():
+        return
+    plot_images(img,
+                images,
                 classes[s_vote] if s_vote > h_vote else classes[h_vote])
 
-    remove_images(fruit)
+
+@click.command()
+@click.option('--out', default='predictions.csv',
+              help="Results file when predicting several images")
+@click.option('--batch-size', default=64,
+              help="Number of images predicted at once by each model")
+@click.option('--backend', default='keras',
+              type=click.Choice(ensemble.BACKENDS),
+              help="Run the models with keras or with their TFLite export")
+@click.option('--fused', is_flag=True,
+              help="Run the single fused model built by Export.py")
+@click.option('--mask-backend', default='plantcv',
+              type=click.Choice(MASK_BACKENDS),
+              help="Implementation of the mask, both giving the same pixels")
+@click.option('--headless', is_flag=True,
+              help="Don't plot a single image's prediction, implied when no"
+                   + " display is available or LEAFFLICTION_HEADLESS=1")
+@click.option('--profile', default=None,
+              help="Write a Chrome trace of the run's stages to this file"
+                   + " and print their timings")
+@click.argument('target')
+def main(target, out, batch_size, backend, fused, mask_backend, headless,
+         profile):
+    """
+    Predicts the class of TARGET, a jpeg image, or of every image of TARGET,
+    a directory or glob pattern
+    """
+    if profile is not None:
+        profiling.enable()
+    set_mask_backend(mask_backend)
+    if os.path.isfile(target):
+        return predict_image(target, backend, fused, profile, headless)
+    predict_batch(target, out, batch_size, backend, fused)
+    profiling.finish(profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+import json
+import time
+import queue
+import socket
+import threading
+import ipaddress
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import numpy as np
+
+from Predict import load_ensemble, load_image
+from Transformation import (transform_all, read_image, decode_image,
+                            to_working_size)
+from utils import dataset_index, ensemble, voting
+
+
+class LatencyStats:
+    """
+    Thread-safe record of the latency of each prediction stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        """
+        Returns:
+            A dict mapping each stage to its count and latency percentiles
+        """
+        with self.lock:
+            samples = {stage: np.array(values)
+                       for stage, values in self.samples.items()}
+        return {stage: {'count': len(values),
+                        'mean_ms': float(values.mean() * 1000),
+                        'p50_ms': float(np.percentile(values, 50) * 1000),
+                        'p95_ms': float(np.percentile(values, 95) * 1000)}
+                for stage, values in samples.items()}
+
+
+class MicroBatcher:
+    """
+    Groups the inputs submitted to a model within a small latency window
+    into a single batch
+    """
+
+    def __init__(self, name, model, window, max_batch, stats):
+        self.name = name
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.stats = stats
+        self.batches = 0
+        self.batched = 0
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, tensor):
+        """
+        Queues one (128, 128, 3) input for the next batch
+        Returns:
+            A Future resolved with the input's class probabilities
+        """
+        future = Future()
+        self.queue.put((tensor, time.perf_counter(), future))
+        return future
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.perf_counter() + self.window
+            while len(items) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            start = time.perf_counter()
+            for _, queued, _ in items:
+                self.stats.record(f'{self.name}.queue', start - queued)
+            try:
+                batch = np.stack([tensor for tensor, _, _ in items])
+                predictions = self.model.predict_on_batch(batch)
+            except Exception as e:
+                for _, _, future in items:
+                    future.set_exception(e)
+                continue
+            self.stats.record(f'{self.name}.inference',
+                              time.perf_counter() - start)
+            self.batches += 1
+            self.batched += len(items)
+            for (_, _, future), prediction in zip(items, predictions):
+                future.set_result(np.asarray(prediction))
+
+
+class PredictionService:
+    """
+    Keeps the models of a fruit resident and predicts images through one
+    micro-batcher per model
+    """
+
+    def __init__(self, fruit, classes_dir, window, max_batch,
+                 backend='keras'):
+        trained = load_ensemble(fruit, backend)
+        if trained is None:
+            raise click.ClickException(f'{fruit} model not trained for the'
+                                       + f' {backend} backend')
+        (models, self.transformations, trained_classes,
+         self.working_size) = trained
+        # Members are lazy, load them all before the first request
+        models = list(models)
+        self.classes = trained_classes or dataset_index.classes(classes_dir)
+        self.stats = LatencyStats()
+        self.batchers = [MicroBatcher(name, model, window, max_batch,
+                                      self.stats)
+                         for name, model in zip(self.transformations,
+                                                models)]
+        # plantcv keeps global state, transformations run one at a time
+        self.transform_lock = threading.Lock()
+
+    def predict(self, img):
+        """
+        Predicts the class of an image
+        Arguments:
+            img (np.ndarray): BGR array of the image
+        Returns:
+            A json-serialisable dict of the votes, probabilities and
+            per-stage latency
+        """
+        latency = {}
+        start = time.perf_counter()
+        with self.transform_lock:
+            outputs = transform_all(to_working_size(img, self.working_size),
+                                    self.transformations, self.working_size)
+        tensors = [load_image(outputs[t])[0] for t in self.transformations]
+        latency['transform'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        futures = [batcher.submit(tensor)
+                   for batcher, tensor in zip(self.batchers, tensors)]
+        predictions = [future.result()[np.newaxis] for future in futures]
+        latency['models'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        s_vote = voting.soft_vote(predictions)[0]
+        h_vote = voting.hard_vote(predictions)[0]
+        probabilities = voting.soft_probabilities(predictions)[0]
+        latency['vote'] = time.perf_counter() - start
+
+        for stage, seconds in latency.items():
+            self.stats.record(stage, seconds)
+        return {'soft_vote': self.classes[s_vote],
+                'hard_vote': self.classes[h_vote],
+                'probabilities': dict(zip(self.classes,
+                                          probabilities.tolist())),
+                'latency_ms': {stage: seconds * 1000
+                               for stage, seconds in latency.items()}}
+
+
+def decode_request(body, content_type, working_size=None):
+    """
+    Decodes the image sent in a request, either as raw jpeg bytes or as a
+    json object holding the path of a local image
+    Arguments:
+        body (bytes): body of the request
+        content_type (str): Content-Type header of the request
+        working_size (int, default: None): side of the square images the
+            models' transformations are computed at, full resolution when
+            None
+    Returns:
+        A BGR array of the image
+    """
+    if content_type.startswith('application/json'):
+        return read_image(json.loads(body)['path'], working_size)
+    img = decode_image(body, working_size)
+    if img is None:
+        raise ValueError("request body is not an image")
+    return img
+
+
+def make_handler(service):
+    """
+    Builds the HTTP handler class serving a PredictionService
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                batch_sizes = {batcher.name: batcher.batched
+                               / max(batcher.batches, 1)
+                               for batcher in service.batchers}
+                return self._reply(200, {'stages': service.stats.summary(),
+                                         'mean_batch_size': batch_sizes})
+            if self.path == '/health':
+                return self._reply(200, {'transformations':
+                                         service.transformations,
+                                         'classes': service.classes})
+            self._reply(404, {'error': f'unknown endpoint {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._reply(404,
+                                   {'error': f'unknown endpoint {self.path}'})
+            start = time.perf_counter()
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                img = decode_request(self.rfile.read(length),
+                                     self.headers.get('Content-Type', ''),
+                                     service.working_size)
+            except Exception as e:
+                return self._reply(400, {'error': str(e)})
+            decode = time.perf_counter() - start
+            service.stats.record('decode', decode)
+            try:
+                result = service.predict(img)
+            except Exception as e:
+                return self._reply(500, {'error': str(e)})
+            result['latency_ms']['decode'] = decode * 1000
+            total = time.perf_counter() - start
+            service.stats.record('total', total)
+            result['latency_ms']['total'] = total * 1000
+            self._reply(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def is_loopback(host):
+    """
+    Checks that a host name or address only resolves to loopback addresses
+    Arguments:
+        host (str): host name or address, e.g. 'localhost' or '127.0.0.1'
+    Returns:
+        True if every address of host is a loopback one
+    Raises:
+        click.BadParameter: if host can't be resolved
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(
+            host, None, proto=socket.IPPROTO_TCP)}
+    except socket.gaierror as e:
+        raise click.BadParameter(f"{host} can't be resolved: {e}",
+                                 param_hint='--host')
+    # Scoped IPv6 addresses end with %interface
+    return all(ipaddress.ip_address(address.split('%')[0]).is_loopback
+               for address in addresses)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1',
+              help="Loopback address the server listens on")
+@click.option('--port', default=8000, help="Port the server listens on")
+@click.option('--classes', 'classes_dir', default=None,
+              help="Dataset directory holding one sub-directory per class,"
+                   + " for joblib ensembles only, defaults to FRUIT")
+@click.option('--window-ms', default=5.0,
+              help="Time a model waits to group requests into a batch")
+@click.option('--max-batch', default=32,
+              help="Maximum number of requests predicted in one batch")
+@click.option('--backend', default='keras',
+              type=click.Choice(ensemble.BACKENDS),
+              help="Run the models with keras or with their TFLite export")
+@click.argument('fruit')
+def main(fruit, host, port, classes_dir, window_ms, max_batch, backend):
+    """
+    Serves the predictions of FRUIT's models on a local HTTP endpoint:
+    POST /predict with jpeg bytes or {"path": ...}, GET /stats, GET /health
+    """
+    if not is_loopback(host):
+        raise click.BadParameter(f"{host} is not a loopback address",
+                                 param_hint='--host')
+    service = PredictionService(fruit, classes_dir or fruit,
+                                window_ms / 1000, max_batch, backend)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving {fruit} predictions on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,348 @@
 import os
-import sys
+import time
+import hashlib
+import click
+import random
+import resource
+import multiprocessing
 import numpy as np
-
-import joblib
+from concurrent.futures import ProcessPoolExecutor
 
 import tensorflow as tf
 from tensorflow.keras import layers, models, callbacks
 from tensorflow.keras.utils import image_dataset_from_directory
 
-
-def help():
-    print("usage: python3 Train.py [folder of images]")
+from Augmentation import augment_random
+from Transformation import manifest_working_size
+from utils import dataset_index, ensemble, profiling, tensor_store
+from utils.voting import soft_vote, hard_vote
+from utils.evaluation import (predict_with_labels, confusion_matrix,
+                              print_confusion_matrix, print_throughput)
+
+
+def peak_rss_mb():
+    """
+    Returns:
+        The peak resident memory of this process, in MB
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class EpochReport(callbacks.Callback):
+    """
+    Records the duration of each epoch and the peak resident memory
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.epoch_times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times.append(time.perf_counter() - self.start)
+        print(f"Epoch {epoch + 1} took {self.epoch_times[-1]:.1f}s,"
+              + f" peak RSS {peak_rss_mb():.0f} MB")
+
+
+def print_epoch_report(reports, cache):
+    """
+    Sums up the epoch times of every model, so that runs with different
+    input pipeline settings can be compared
+    Arguments:
+        reports (dict): train_member result of each transformation's model
+        cache (str): cache setting of the run
+    """
+    print(f"\nInput pipeline cache: {cache}")
+    print(f"{'model':<17}{'first epoch (s)':>17}{'next epochs (s)':>17}"
+          + f"{'peak RSS (MB)':>15}")
+    for name, report in reports.items():
+        times = report['epoch_times']
+        later = np.mean(times[1:]) if len(times) > 1 else float('nan')
+        print(f"{name:<17}{times[0]:>17.1f}{later:>17.1f}"
+              + f"{report['peak_rss_mb']:>15.0f}")
+
+
+# Seed of the in-memory augmentations, offset by each example's position
+AUGMENT_SEED = 42
+
+
+def augment_rgb(img, seed):
+    """
+    Applies one augmentation of Augmentation.py picked at random, or none,
+    to an RGB image
+    Arguments:
+        img (np.ndarray): (height, width, 3) RGB uint8 array
+        seed (int): seed of this example's augmentation, so that a run is
+            reproducible whichever thread augments the example
+    Returns:
+        An array of the same shape and type
+    """
+    augmented = augment_random(np.ascontiguousarray(img[..., ::-1]),
+                               random.Random(int(seed)))
+    return np.ascontiguousarray(augmented[..., ::-1])
+
+
+def load_image(path, label):
+    """
+    Decodes and resizes an image file the way image_dataset_from_directory
+    does
+    Arguments:
+        path (tf.Tensor): path to the image
+        label (tf.Tensor): class of the image
+    Returns:
+        The (128, 128, 3) float32 image and its label
+    """
+    img = tf.io.decode_image(tf.io.read_file(path), channels=3,
+                             expand_animations=False)
+    img = tf.image.resize(img, (128, 128), method='bilinear')
+    return tf.ensure_shape(img, (128, 128, 3)), label
+
+
+def to_uint8(x, y):
+    """
+    Rounds a decoded image back to uint8, 4x smaller to cache than float32
+    """
+    return tf.cast(tf.clip_by_value(tf.round(x), 0, 255), tf.uint8), y
+
+
+def cache_dataset(dataset, cache, name):
+    """
+    Caches a dataset as requested
+    Arguments:
+        dataset (tf.data.Dataset): dataset to cache
+        cache (str): 'none', 'memory' or a directory for on-disk cache files
+        name (str): name of the cache file in the cache directory
+    Returns:
+        The cached tf.data.Dataset
+    """
+    if cache == 'memory':
+        return dataset.cache()
+    if cache != 'none':
+        os.makedirs(cache, exist_ok=True)
+        return dataset.cache(os.path.join(cache, name))
+    return dataset
+
+
+def class_files(dataset):
+    """
+    Groups the files of a split made by image_dataset_from_directory by class
+    Returns:
+        A list holding the list of paths of each class, in label order
+    """
+    files = [[] for _ in dataset.class_names]
+    for path in dataset.file_paths:
+        label = os.path.basename(os.path.dirname(path))
+        files[dataset.class_names.index(label)].append(path)
+    return files
+
+
+def oversample(files, cache, name):
+    """
+    Draws the examples of every class equally often, repeating those of the
+    smaller classes, so that classes are balanced in memory. Each class is
+    read from its own files into its own cache, so that a pass over a small
+    class decodes only that class
+    Arguments:
+        files (list): paths of each class, as returned by class_files
+        cache (str): 'none', 'memory' or a directory for on-disk cache files
+        name (str): name of the cache files, suffixed by the class label
+    Returns:
+        The infinite tf.data.Dataset of balanced (image, label) examples
+    """
+    per_class = []
+    for label, paths in enumerate(files):
+        if not paths:
+            continue
+        examples = tf.data.Dataset.from_tensor_slices(
+            (paths, [label] * len(paths))).map(
+            lambda path, y: to_uint8(*load_image(path, y)),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        examples = cache_dataset(examples, cache, f'{name}_class{label}')
+        per_class.append(examples.shuffle(1024, seed=42).repeat())
+    return tf.data.Dataset.sample_from_datasets(per_class, seed=42)
+
+
+def prepare_dataset(dataset, cache, name, training, augment=False):
+    """
+    Turns a dataset from image_dataset_from_directory into a cached,
+    prefetched input pipeline. Images stay uint8 until the model's
+    Rescaling layer
+    Arguments:
+        dataset (tf.data.Dataset): batched dataset of decoded images
+        cache (str): 'none', 'memory' or a directory for on-disk cache files
+        name (str): name of the cache file in the cache directory
+        training (boolean): reshuffle the examples at each epoch
+        augment (boolean, default: False): balance the classes of a
+            training dataset by oversampling and augmenting their examples
+    Returns:
+        The batched tf.data.Dataset, with its class_names and the
+        steps_per_epoch of an oversampled dataset
+    """
+    class_names = dataset.class_names
+    steps_per_epoch = None
+    if training and augment:
+        files = class_files(dataset)
+        counts = [len(paths) for paths in files]
+        # Numbering the examples seeds each augmentation by its position
+        dataset = oversample(files, cache, name).enumerate(AUGMENT_SEED).map(
+            lambda i, example: (tf.ensure_shape(
+                tf.numpy_function(augment_rgb, [example[0], i], tf.uint8),
+                example[0].shape), example[1]),
+            num_parallel_calls=tf.data.AUTOTUNE)
+        # An epoch sees as many examples of each class as the largest has
+        steps_per_epoch = -(-max(counts) * sum(map(bool, counts)) // 32)
+    else:
+        dataset = cache_dataset(dataset.unbatch().map(
+            to_uint8, num_parallel_calls=tf.data.AUTOTUNE), cache, name)
+        if training:
+            dataset = dataset.shuffle(1024, seed=42)
+    dataset = dataset.batch(32).prefetch(tf.data.AUTOTUNE)
+    dataset.class_names = class_names
+    dataset.steps_per_epoch = steps_per_epoch
+    return dataset
+
+
+def cache_prefix(directory, name):
+    """
+    Names the on-disk cache files of a directory after its fruit, its
+    location and its content. tf.data reuses an existing cache file without
+    checking it, so another fruit or changed images must not share its name
+    Arguments:
+        directory (str): directory holding one sub-directory per class
+        name (str): name of the transformation
+    Returns:
+        The prefix of the cache files
+    """
+    key = (os.path.abspath(directory) + '\0'
+           + dataset_index.fingerprint(directory))
+    fruit = os.path.basename(os.path.dirname(os.path.abspath(directory)))
+    return f'{fruit}_{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}'
+
+
+def make_datasets(directory, cache='none', name='data', augment=False):
+    """
+    Builds the training and validation input pipelines of a directory of
+    images. Files are read and decoded in parallel by
+    image_dataset_from_directory
+    Arguments:
+        directory (str): directory holding one sub-directory per class
+        cache (str, default: 'none'): 'none', 'memory' or a directory for
+            on-disk cache files
+        name (str, default: 'data'): name of the on-disk cache files, along
+            with the directory's fruit and content hash
+        augment (boolean, default: False): balance and augment the training
+            examples in memory
+    Returns:
+        A (training, validation) tuple of tf.data.Dataset
+    """
+    data = image_dataset_from_directory(
+        directory,
+        validation_split=0.2,    # 0.8 for training, 0.2 for validation
+        subset="both",
+        shuffle=True,
+        seed=42,
+        image_size=(128, 128),   # 4x less memory and time than (256,256)
+    )
+    if cache not in ('none', 'memory'):
+        name = cache_prefix(directory, name)
+    return (prepare_dataset(data[0], cache, f'{name}_training', True,
+                            augment),
+            prepare_dataset(in_order(data[1]), cache, f'{name}_validation',
+                            False))
+
+
+def in_order(dataset):
+    """
+    Rebuilds a split of image_dataset_from_directory that yields its images
+    in the same order at every iteration. The original one reshuffles at
+    each iteration, which misaligns the predictions of different models
+    Arguments:
+        dataset (tf.data.Dataset): split made by image_dataset_from_directory
+    Returns:
+        The batched tf.data.Dataset of the same images, decoded and resized
+        the same way, with its class_names and file_paths
+    """
+    class_names = dataset.class_names
+    paths = list(dataset.file_paths)
+    labels = [class_names.index(os.path.basename(os.path.dirname(path)))
+              for path in paths]
+    ordered = tf.data.Dataset.from_tensor_slices((paths, labels)).map(
+        load_image, num_parallel_calls=tf.data.AUTOTUNE).batch(32)
+    ordered.class_names = class_names
+    ordered.file_paths = paths
+    return ordered
+
+
+class StoreSequence(tf.keras.utils.Sequence):
+    """
+    Batches of one transformation's images read from a tensor store,
+    without decoding any image
+    """
+
+    def __init__(self, store, name, subset, training, batch_size=32,
+                 augment=False):
+        super().__init__()
+        self.store = store
+        self.name = name
+        self.rows = store.indices(subset)
+        self.training = training
+        self.augment = augment and training
+        self.batch_size = batch_size
+        self.class_names = store.classes
+        self.steps_per_epoch = None
+        self.rng = np.random.default_rng(42)
+        self.order = self.rows
+        self.epoch = 0
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.order) // self.batch_size)
+
+    def __getitem__(self, i):
+        # Sorted rows read the memory-mapped shards sequentially
+        rows = np.sort(self.order[i * self.batch_size:
+                                  (i + 1) * self.batch_size])
+        images = self.store.take(self.name, rows)
+        if self.augment:
+            start = AUGMENT_SEED + ((self.epoch * len(self) + i)
+                                    * self.batch_size)
+            images = np.stack([augment_rgb(img, start + k)
+                               for k, img in enumerate(images)])
+        return images, np.asarray(self.store.labels[rows])
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.augment:
+            # Every class contributes as many rows as the largest one
+            labels = np.asarray(self.store.labels[self.rows])
+            per_class = [self.rows[labels == label]
+                         for label in np.unique(labels)]
+            largest = max(len(rows) for rows in per_class)
+            self.order = self.rng.permutation(np.concatenate(
+                [np.concatenate([rows, self.rng.choice(
+                    rows, largest - len(rows))])
+                 for rows in per_class]))
+        elif self.training:
+            self.order = self.rng.permutation(self.rows)
+
+
+def make_store_datasets(store, name, augment=False):
+    """
+    Builds the training and validation sequences of one transformation
+    from a tensor store
+    Arguments:
+        store (TensorStore): store built by BuildTensorStore.py
+        name (str): transformation
+        augment (boolean, default: False): balance and augment the training
+            examples in memory
+    Returns:
+        A (training, validation) tuple of StoreSequence
+    """
+    return (StoreSequence(store, name, 'training', True, augment=augment),
+            StoreSequence(store, name, 'validation', False))
 
 
 def make_model(dataset):
@@ -38,44 +370,14 @@ def make_model(dataset):
     return model
 
 
-def soft_vote(predictions):
-    # Stack the predictions along the first axis to form a 3D array
-    # (num_samples, num_models, num_classes)
-    stacked_predictions = np.stack(predictions, axis=1)
-
-    # Compute the average prediction for each sample and class (soft vote)
-    ensemble_prediction = np.mean(stacked_predictions, axis=1)
-
-    # Convert the ensemble predictions to class labels
-    # (index of the maximum probability)
-    ensemble_prediction = np.argmax(ensemble_prediction, axis=1)
-
-    return ensemble_prediction
-
-
-def hard_vote(predictions):
-    # print(predictions)
-    nb_classes = len(predictions[0][0])
-    # print(f'nb_classes = {nb_classes}')
-    # Stack the predictions along the first axis to form a 3D array
-    # (num_samples, num_models, num_classes)
-    stacked_pred = np.stack(predictions, axis=1)
-
-    # Concatenate the innermost arrays along the last axis
-    # (num_samples, num_models * num_classes)
-    concatenated_pred = stacked_pred.reshape(stacked_pred.shape[0], -1)
-
-    # Compute the majority vote for each sample and class (hard vote)
-    ensemble_prediction = np.argmax(concatenated_pred, axis=-1)
-    true_ensemble = []
-    for i in range(len(ensemble_prediction)):
-        true_ensemble.append(ensemble_prediction[i] % nb_classes)
-    return true_ensemble
-
-
 def print_accuracy(data, ensemble_prediction, mode="soft"):
-    # Get the ground truth labels from the test dataset
-    test_labels = np.concatenate([y for _, y in data], axis=0)
+    # Get the ground truth labels from the test dataset, unless given. Labels
+    # collected along with the predictions by predict_with_labels are always
+    # aligned, iterating the dataset again may not be
+    if isinstance(data, np.ndarray):
+        test_labels = data
+    else:
+        test_labels = np.concatenate([y for _, y in data], axis=0)
     # Now 'ensemble_prediction' contains the final ensemble prediction
     # for the test dataset.
     # Each element of 'ensemble_prediction' will be an array of probabilities
@@ -89,68 +391,191 @@ def print_accuracy(data, ensemble_prediction, mode="soft"):
     accuracy = correct_predictions / len(test_labels)
 
     print(f"Accuracy {mode} vote:", accuracy)
-    return
-
-
-def main():
-    # argument
-    if len(sys.argv) != 2:
-        return help()
-    if os.path.isdir(sys.argv[1]) is False:
-        return print("Argument {} is not a directory".format(sys.argv[1]))
-
-    fruit = sys.argv[1].split('/', 1)[1]
-    jl_name = os.path.join(sys.argv[1] + '.joblib')
-    data_acc = None
-    predictions_validation = []
-    subdirs = [elt for elt in os.listdir(sys.argv[1]) if fruit not in elt]
-    subdirs = sorted(subdirs)
-    models = [0] * len(subdirs)
-    for i in range(len(subdirs)):
-        print(f'Training {subdirs[i]} model')
-        # data preprocessing
-        data = image_dataset_from_directory(
-            os.path.join(sys.argv[1], subdirs[i]),
-            validation_split=0.2,    # 0.8 for training, 0.2 for validation
-            subset="both",
-            shuffle=True,
-            seed=42,
-            image_size=(128, 128),   # 4x less memory and time than (256,256)
-        )
-        train_data = data[0]
-        validation_data = data[1]
-        data_acc = data[1]
-
-        # create model
-        model = make_model(train_data)
-
-        # Create a learning rate scheduler callback.
-        reduce_lr = callbacks.ReduceLROnPlateau(
-            monitor="val_loss", factor=0.4, patience=5
-        )
-        # Create an early stopping callback.
-        early_stopping = callbacks.EarlyStopping(
-            monitor="val_loss", patience=5, restore_best_weights=True
-        )
+    return accuracy
+
+
+def train_member(directory, name, cache, model_path, threads=None,
+                 store=False, augment=False):
+    """
+    Trains the model of one transformation and saves it into the ensemble
+    artifact. Runs in its own process when models are trained concurrently
+    Arguments:
+        directory (str): transformed dataset holding one sub-directory per
+            transformation
+        name (str): transformation whose model is trained
+        cache (str): 'none', 'memory' or a directory for on-disk cache files
+        model_path (str): directory of the ensemble artifact
+        threads (int, default: None): intra-op threads given to TensorFlow,
+            TensorFlow's default when None
+        store (boolean, default: False): read the images from the tensor
+            store of the directory instead of decoding them
+        augment (boolean, default: False): balance the classes by
+            oversampling and augmenting the training images in memory
+    Returns:
+        A dict with the validation predictions and labels, the class names,
+        the epoch times and the peak RSS of the training
+    """
+    if threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+    print(f'Training {name} model')
+    # data preprocessing
+    with profiling.stage(f'{name}.datasets'):
+        if store:
+            train_data, validation_data = make_store_datasets(
+                tensor_store.open_store(directory), name, augment)
+        else:
+            train_data, validation_data = make_datasets(
+                os.path.join(directory, name), cache, name, augment)
+
+    # create model
+    model = make_model(train_data)
+
+    # Create a learning rate scheduler callback.
+    reduce_lr = callbacks.ReduceLROnPlateau(
+        monitor="val_loss", factor=0.4, patience=5
+    )
+    # Create an early stopping callback.
+    early_stopping = callbacks.EarlyStopping(
+        monitor="val_loss", patience=5, restore_best_weights=True
+    )
+    report = EpochReport()
 
-        # fit model
+    # fit model
+    with profiling.stage(f'{name}.fit'):
         model.fit(
             train_data,
             epochs=3,
+            steps_per_epoch=train_data.steps_per_epoch,
             validation_data=validation_data,
-            callbacks=[early_stopping, reduce_lr]
+            callbacks=[early_stopping, reduce_lr, report],
+            verbose=2 if threads is not None else 1
         )
-
-        models[i] = model
-        predictions_validation.append(model.predict(validation_data))
-        print()
-
+    profiling.count('epochs', len(report.epoch_times))
+
+    with profiling.stage(f'{name}.save'):
+        ensemble.save_member(model_path, name, model)
+    print()
+    with profiling.stage(f'{name}.predict'):
+        evaluation = predict_with_labels(model, validation_data)
+    return {'predictions': evaluation['predictions'],
+            'labels': evaluation['labels'],
+            'images': evaluation['images'],
+            'seconds': evaluation['seconds'],
+            'class_names': train_data.class_names,
+            'epoch_times': report.epoch_times,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def train_concurrently(directory, subdirs, cache, model_path, jobs,
+                       store=False, augment=False):
+    """
+    Trains the models of every transformation in separate processes, each
+    with its share of the cores
+    Arguments:
+        directory (str): transformed dataset
+        subdirs (list): transformations whose models are trained
+        cache (str): 'none', 'memory' or a directory for on-disk cache files
+        model_path (str): directory of the ensemble artifact
+        jobs (int): number of models trained at once
+        store (boolean, default: False): read the images from the tensor
+            store, whose pages every process shares
+        augment (boolean, default: False): balance and augment the training
+            images in memory
+    Returns:
+        The train_member results, in transformation order
+    """
+    jobs = min(jobs, len(subdirs))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    # TensorFlow doesn't survive a fork, each worker starts afresh
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+        futures = [pool.submit(profiling.wrap(train_member), directory,
+                               name, cache, model_path, threads, store,
+                               augment)
+                   for name in subdirs]
+        return [profiling.unwrap(future.result()) for future in futures]
+
+
+@click.command()
+@click.option('--cache', default='none',
+              help="Cache of the decoded 128x128 images: 'none', 'memory'"
+                   + " or a directory for on-disk cache files")
+@click.option('--jobs', default=1,
+              help="Number of transformation models trained concurrently,"
+                   + " each in its own process")
+@click.option('--store', is_flag=True,
+              help="Read the images from the tensor store built by"
+                   + " BuildTensorStore.py instead of decoding them")
+@click.option('--augment', is_flag=True,
+              help="Balance the classes by oversampling them with the"
+                   + " augmentations of Augmentation.py, in memory instead"
+                   + " of running GenerateAugmentedDirectory.py. Best with"
+                   + " --cache or --store, as the smaller classes are read"
+                   + " again and again")
+@click.option('--profile', default=None,
+              help="Write a Chrome trace of the run's stages to this file"
+                   + " and print their timings")
+@click.argument('directory')
+def main(directory, cache, jobs, store, augment, profile):
+    """
+    Trains one model per transformation of DIRECTORY and saves the ensemble
+    """
+    if os.path.isdir(directory) is False:
+        return print("Argument {} is not a directory".format(directory))
+    if profile is not None:
+        profiling.enable()
+
+    fruit = directory.split('/', 1)[1]
+    model_path = ensemble.artifact_path(directory)
+    subdirs = [elt for elt in dataset_index.classes(directory)
+               if fruit not in elt]
+    if store and tensor_store.open_store(directory) is None:
+        return print(f"{tensor_store.store_path(directory)} not found,"
+                     + " run BuildTensorStore.py first")
+    try:
+        # Predictions must transform images at the same working size
+        working_size = manifest_working_size(directory)
+    except ValueError as e:
+        return print(e)
+    # Exports and members of the previous ensemble would keep serving their
+    # weights
+    ensemble.clear_exports(model_path, subdirs)
+    if jobs > 1:
+        results = train_concurrently(directory, subdirs, cache, model_path,
+                                     jobs, store, augment)
+    else:
+        results = [train_member(directory, name, cache, model_path,
+                                store=store, augment=augment)
+                   for name in subdirs]
+
+    predictions_validation = [result['predictions'] for result in results]
+    data_acc = results[-1]['labels']
+    if any(not np.array_equal(result['labels'], data_acc)
+           for result in results):
+        print("Warning: the validation images of the models differ, votes"
+              + " mix predictions of different images")
+    classes = results[-1]['class_names']
     soft_vote_predictions = soft_vote(predictions_validation)
     hard_vote_predictions = hard_vote(predictions_validation)
     print_accuracy(data_acc, soft_vote_predictions, "soft")
     print_accuracy(data_acc, hard_vote_predictions, "hard")
-
-    joblib.dump(models, jl_name)
+    for mode, votes in [('soft', soft_vote_predictions),
+                        ('hard', hard_vote_predictions)]:
+        print_confusion_matrix(
+            confusion_matrix(data_acc, votes, len(classes)), classes, mode)
+    print_throughput({name: result for name, result
+                      in zip(subdirs, results)})
+    print_epoch_report({name: result for name, result
+                        in zip(subdirs, results)}, cache)
+
+    ensemble.write_metadata(model_path, transformations=subdirs,
+                            classes=classes,
+                            input_size=[128, 128],
+                            working_size=working_size,
+                            data_hash=dataset_index.fingerprint(directory))
+    print(f"Ensemble saved to {model_path}")
+    profiling.finish(profile)
 
 
 if __name__ == "__main__":
@@ -1,54 +1,251 @@
 import os
+import io
+import cv2
 import filetype
-import fnmatch
-from plantcv import plantcv as pcv
-import matplotlib.pyplot as plt
+import functools
+import json
+import threading
+import multiprocessing
+import numpy as np
 import click
 
-
-def find(pattern, path):
+from Distribution import jpeg_dimensions
+from utils import dataset_index, lazy, profiling
+
+# plantcv pulls in matplotlib, scikit-image and pandas, only load it once a
+# transformation needs it
+pcv = lazy.lazy_import('plantcv.plantcv')
+
+
+# Suffix of the file written for each single transformation type
+TYPE_SUFFIXES = {
+    'blur': "_BLURRED.JPG",
+    'maskblur': "_MASKBLUR.JPG",
+    'mask': "_MASKED.JPG",
+    'roi': "_ROI_OBJECTS.JPG",
+    'analysis': "_ANALYZED.JPG",
+    'pseudolandmarks': "_PSEUDOLANDMARKS.JPG",
+    'colors': "_COLORS.JPG",
+}
+# Transformations covered by the 'all' type, i.e. the ones models train on
+ALL_TYPES = ['blur', 'mask', 'roi', 'analysis', 'pseudolandmarks']
+# Parameters the transformed images depend on, recorded in the manifest so
+# that changing one of them invalidates previous outputs
+TRANSFORM_PARAMS = {
+    'version': 1,
+    'threshold': 60,
+    'erode_ksize': 3,
+    'blur_ksize': 11,
+}
+# Side of the dataset images the pixel sizes above are tuned for
+REFERENCE_SIZE = 256
+# Name of the manifest kept in a destination directory
+MANIFEST_NAME = '.transform_manifest.json'
+# Implementations of mask_image, giving identical masks
+MASK_BACKENDS = ['plantcv', 'opencv']
+# Backend used by mask_image, see set_mask_backend
+mask_backend = 'plantcv'
+# Reusable buffers of the opencv mask backend, one set per thread
+_mask_buffers = threading.local()
+
+
+def set_mask_backend(backend: str) -> None:
     """
-    Finds the file whose name matches the requested pattern
+    Selects the implementation of mask_image for this process. Also used as
+    process pool initializer so that workers use the same one
     Arguments:
-        pattern (string): requested pattern
-        path (string): path where the file must be searched
-    Returns:
-        Complete path to the file, or None if file wasn't found
+        backend (str): one of MASK_BACKENDS
+    """
+    global mask_backend
+    if backend not in MASK_BACKENDS:
+        raise ValueError(f"Unknown mask backend {backend}")
+    mask_backend = backend
+
+
+class MaskBuffers:
     """
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            if fnmatch.fnmatch(name, pattern):
-                return os.path.join(root, name)
-    return None
+    Preallocated intermediate and output arrays of mask_image_opencv, for
+    images of one shape
+    """
+
+    def __init__(self, shape: tuple):
+        self.shape = shape
+        self.hsv = np.empty(shape, dtype=np.uint8)
+        self.saturation = np.empty(shape[:2], dtype=np.uint8)
+        self.threshold = np.empty(shape[:2], dtype=np.uint8)
+        self.mask = np.empty(shape[:2], dtype=np.uint8)
+
+
+_erode_kernel = np.ones((TRANSFORM_PARAMS['erode_ksize'],) * 2, np.uint8)
 
 
-def mask_image(img):
+def mask_image_opencv(img, buffers: MaskBuffers = None):
+    """
+    Generates the same mask as the plantcv pipeline of mask_image, calling
+    OpenCV directly. The 'dark' threshold followed by an inversion is a
+    single plain binary threshold
+    Arguments:
+        img (np.ndarray): Array representing the image
+        buffers (MaskBuffers, default: None): arrays written into instead
+            of allocating new ones, the mask being buffers.mask
+    Returns:
+        A np.ndarray representing the mask of the image
+    """
+    if buffers is None:
+        buffers = MaskBuffers(img.shape)
+    cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=buffers.hsv)
+    cv2.extractChannel(buffers.hsv, 1, dst=buffers.saturation)
+    cv2.threshold(buffers.saturation, TRANSFORM_PARAMS['threshold'], 255,
+                  cv2.THRESH_BINARY, dst=buffers.threshold)
+    cv2.erode(buffers.threshold, _erode_kernel, dst=buffers.mask,
+              iterations=1)
+    return buffers.mask
+
+
+def mask_image(img, backend: str = None):
     """
     Generates the black and white mask necessary for many transformations
     Arguments:
         img (np.ndarray): Array representing the image
+        backend (str, default: None): one of MASK_BACKENDS, the one chosen
+            by set_mask_backend when None
     Returns:
         A np.ndarray representing the mask of the image
     """
+    if (backend or mask_backend) == 'opencv':
+        # Intermediate arrays are reused, the mask itself is returned
+        buffers = getattr(_mask_buffers, 'buffers', None)
+        if buffers is None or buffers.shape != img.shape:
+            buffers = _mask_buffers.buffers = MaskBuffers(img.shape)
+        return mask_image_opencv(img, buffers).copy()
     gray_img = pcv.rgb2gray_hsv(rgb_img=img, channel='s')
     threshold = pcv.threshold.binary(gray_img=gray_img,
-                                     threshold=60,
+                                     threshold=TRANSFORM_PARAMS['threshold'],
                                      max_value=255,
                                      object_type='dark')
     mask = pcv.invert(threshold)
-    mask = pcv.erode(gray_img=mask, ksize=3, i=1)
+    mask = pcv.erode(gray_img=mask, ksize=TRANSFORM_PARAMS['erode_ksize'],
+                     i=1)
     return mask
 
 
-def transform_gaussian_blur(img):
+def reduction_flag(width: int, height: int, working_size: int) -> int:
+    """
+    Picks the largest reduction libjpeg can decode an image at while it
+    stays at least as large as the working size
+    Arguments:
+        width (int): width of the image
+        height (int): height of the image
+        working_size (int): side of the square images transformed
+    Returns:
+        The cv2.imread flag of the reduced decoding
+    """
+    for factor, flag in [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                         (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+        if min(width, height) // factor >= working_size:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def to_working_size(img, working_size: int = None):
+    """
+    Squashes an image to the square working size, averaging pixels with
+    area interpolation as the reduced jpeg decoding does
+    Arguments:
+        img (np.ndarray): Array representing the image
+        working_size (int, default: None): side of the square images
+            transformed, full resolution when None
+    Returns:
+        A np.ndarray of the resized image, img itself if already there
+    """
+    if working_size is None or img.shape[:2] == (working_size,) * 2:
+        return img
+    return cv2.resize(img, (working_size, working_size),
+                      interpolation=cv2.INTER_AREA)
+
+
+def read_image(img_path: str, working_size: int = None):
+    """
+    Decodes an image, at reduced resolution when a working size is given:
+    jpeg images are decoded straight at the smallest size libjpeg can
+    produce above it, then resized to it
+    Arguments:
+        img_path (string): path to the image
+        working_size (int, default: None): side of the square images
+            transformed, full resolution when None
+    Returns:
+        A BGR np.ndarray of the image
+    """
+    if working_size is None:
+        img, path, filename = pcv.readimage(img_path)
+        return img
+    # Orientation ignored, as pcv.readimage does
+    img = cv2.imread(img_path, _decode_flag(jpeg_dimensions(img_path),
+                                            working_size))
+    if img is None:
+        pcv.fatal_error("Failed to open " + img_path)
+    return to_working_size(img, working_size)
+
+
+def _decode_flag(dimensions: tuple, working_size: int = None) -> int:
+    """
+    Gives the flags decoding an image the way read_image does
+    Arguments:
+        dimensions (tuple): (width, height) of the image, None if unknown
+        working_size (int, default: None): side of the square images
+            transformed, full resolution when None
+    Returns:
+        The cv2.imread or cv2.imdecode flags
+    """
+    flag = cv2.IMREAD_COLOR
+    if working_size is not None and dimensions is not None:
+        flag = reduction_flag(*dimensions, working_size)
+    return flag | cv2.IMREAD_IGNORE_ORIENTATION
+
+
+def decode_image(data: bytes, working_size: int = None):
+    """
+    Decodes an image held in memory exactly as read_image decodes a file,
+    at reduced resolution when a working size is given
+    Arguments:
+        data (bytes): content of the image file
+        working_size (int, default: None): side of the square images
+            transformed, full resolution when None
+    Returns:
+        A BGR np.ndarray of the image, or None if data isn't an image
+    """
+    flag = _decode_flag(None if working_size is None
+                        else jpeg_dimensions(io.BytesIO(data)), working_size)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        return None
+    return to_working_size(img, working_size)
+
+
+def scaled_ksize(ksize: int, scale: float) -> int:
+    """
+    Scales a kernel size tuned for REFERENCE_SIZE images
+    Arguments:
+        ksize (int): odd kernel size at full resolution
+        scale (float): working size over REFERENCE_SIZE
+    Returns:
+        The closest odd kernel size, at least 3
+    """
+    return max(3, int(round(ksize * scale)) // 2 * 2 + 1)
+
+
+def transform_gaussian_blur(img, scale: float = 1.0):
     """
     Generates a gaussian blur transformation of the image
     Arguments:
         img (np.ndarray): Array representing the image
+        scale (float, default: 1.0): working size over REFERENCE_SIZE
     Returns:
         A np.ndarray representing the transformed image
     """
-    return pcv.gaussian_blur(img, ksize=(11, 11))
+    ksize = scaled_ksize(TRANSFORM_PARAMS['blur_ksize'], scale)
+    return pcv.gaussian_blur(img, ksize=(ksize, ksize))
 
 
 def transform_masked(img):
@@ -63,32 +260,71 @@ def transform_masked(img):
     return pcv.apply_mask(img=img, mask=mask, mask_color='white')
 
 
-def transform_roi(img, dst='.'):
+def render_roi(img, objects, object_hierarchy):
     """
-    Finds ROI objects on the img and generates a representation of them
+    Draws the objects kept by a whole-image ROI the same way plantcv's
+    roi_objects debug output does, without writing it to disk
     Arguments:
         img (np.ndarray): Array representing the image
-        dst (str): Destination directory for the temporary files
+        objects (list): contours found by pcv.find_objects
+        object_hierarchy (np.ndarray): hierarchy found by pcv.find_objects
     Returns:
         A np.ndarray representing the transformed image
     """
-    pcv.params.debug_outdir = dst
-    mask = mask_image(img)
-    objects, object_hierarchy = pcv.find_objects(img, mask)
     contour, hierarchy = pcv.roi.rectangle(img, 0, 0,
                                            img.shape[0],
                                            img.shape[1])
-    pcv.params.debug = 'print'
-    pcv.roi_objects(img=img, roi_contour=contour, roi_hierarchy=hierarchy,
-                    object_contour=objects, obj_hierarchy=object_hierarchy,
-                    roi_type='partial')
-    pcv.params.debug = 'None'
-    roi_file = find("*_obj_on_img.png", dst)
-    trash_file = find("*_roi_mask.png", dst)
-    transformed_img, path, filename = pcv.readimage(roi_file)
-    os.remove(trash_file)
-    os.remove(roi_file)
-    return transformed_img
+    kept, kept_hierarchy, _, _ = pcv.roi_objects(
+        img=img, roi_contour=contour, roi_hierarchy=hierarchy,
+        object_contour=objects, obj_hierarchy=object_hierarchy,
+        roi_type='partial')
+    roi_img = np.copy(img)
+    cv2.drawContours(roi_img, kept, -1, (0, 255, 0), -1, lineType=8,
+                     hierarchy=kept_hierarchy)
+    cv2.drawContours(roi_img, contour, -1, (255, 0, 0),
+                     pcv.params.line_thickness, lineType=8,
+                     hierarchy=hierarchy)
+    return roi_img
+
+
+def render_pseudolandmarks(img, obj, mask):
+    """
+    Draws the y-axis pseudolandmarks of an object the same way plantcv's
+    debug output does, without writing it to disk
+    Arguments:
+        img (np.ndarray): Array representing the image
+        obj (np.ndarray): composed object from pcv.object_composition
+        mask (np.ndarray): composed mask from pcv.object_composition
+    Returns:
+        A np.ndarray representing the transformed image
+    """
+    landmarks_img = np.copy(img)
+    if obj is None or not np.any(obj):
+        return landmarks_img
+    left, right, center = pcv.y_axis_pseudolandmarks(img=img, obj=obj,
+                                                     mask=mask,
+                                                     label="default")
+    for points, color in [(left, (255, 0, 0)),
+                          (right, (255, 0, 255)),
+                          (center, (0, 79, 255))]:
+        for point in points:
+            cv2.circle(landmarks_img,
+                       (int(point[0, 0]), int(point[0, 1])),
+                       pcv.params.line_thickness, color, -1)
+    return landmarks_img
+
+
+def transform_roi(img):
+    """
+    Finds ROI objects on the img and generates a representation of them
+    Arguments:
+        img (np.ndarray): Array representing the image
+    Returns:
+        A np.ndarray representing the transformed image
+    """
+    mask = mask_image(img)
+    objects, object_hierarchy = pcv.find_objects(img, mask)
+    return render_roi(img, objects, object_hierarchy)
 
 
 def transform_analysis(img):
@@ -107,28 +343,20 @@ def transform_analysis(img):
     return pcv.analyze_object(img, obj, mask)
 
 
-def transform_pseudolandmarks(img, dst='.'):
+def transform_pseudolandmarks(img):
     """
     Finds pseudolandmarks on the img and generates a representation of them
     Arguments:
         img (np.ndarray): Array representing the image
-        dst (str): Destination directory for the temporary files
     Returns:
         A np.ndarray representing the transformed image
     """
-    pcv.params.debug_outdir = dst
     mask = mask_image(img)
     objects, object_hierarchy = pcv.find_objects(img, mask)
     obj, mask = pcv.object_composition(img=img,
                                        contours=objects,
                                        hierarchy=object_hierarchy)
-    pcv.params.debug = 'print'
-    pcv.y_axis_pseudolandmarks(img=img, obj=obj, mask=mask, label="default")
-    pcv.params.debug = 'None'
-    pseudolandmarks_file = find("*_pseudolandmarks.png", dst)
-    transformed_img, path, filename = pcv.readimage(pseudolandmarks_file)
-    os.remove(pseudolandmarks_file)
-    return transformed_img
+    return render_pseudolandmarks(img, obj, mask)
 
 
 def transform_colors(img):
@@ -144,87 +372,412 @@ def transform_colors(img):
                              colorspaces='all', label="default")
 
 
-def transform_image(img_path: str, dst: str, type: str) -> None:
+def expand_types(type: str) -> list:
+    """
+    Lists the single transformations covered by a requested type
+    Arguments:
+        type (string): type of transformation requested
+    Returns:
+        A list of single transformation types
+    """
+    if type == 'all':
+        return list(ALL_TYPES)
+    return [type]
+
+
+def transform_all(img, types: list, working_size: int = None) -> dict:
+    """
+    Renders every requested transformation of an image in a single pass:
+    the mask, the objects and the composed object are computed at most once
+    and every output stays in memory
+    Arguments:
+        img (np.ndarray): Array representing the image
+        types (list): single transformation types to render
+        working_size (int, default: None): side of img when it was read at
+            a working size, the blur kernel and line widths being scaled to
+            it. The erosion stays 3x3, the smallest one
+    Returns:
+        A dict mapping each requested type to its transformed image
+    """
+    if working_size is None:
+        return _transform_all(img, types)
+    scale = working_size / REFERENCE_SIZE
+    line_thickness = pcv.params.line_thickness
+    pcv.params.line_thickness = max(1, int(round(line_thickness * scale)))
+    try:
+        return _transform_all(img, types, scale)
+    finally:
+        pcv.params.line_thickness = line_thickness
+
+
+def _transform_all(img, types: list, scale: float = 1.0) -> dict:
+    """
+    Renders the transformations of transform_all
+    Arguments:
+        img (np.ndarray): Array representing the image
+        types (list): single transformation types to render
+        scale (float, default: 1.0): working size over REFERENCE_SIZE
+    Returns:
+        A dict mapping each requested type to its transformed image
     """
-    Performs six image transformations on an image using PlantCV's functions
+    outputs = {}
+    if 'blur' in types:
+        with profiling.stage('blur'):
+            outputs['blur'] = transform_gaussian_blur(img, scale)
+    if set(types) <= {'blur'}:
+        return outputs
+
+    with profiling.stage('mask'):
+        mask = mask_image(img)
+    if 'maskblur' in types:
+        with profiling.stage('maskblur'):
+            outputs['maskblur'] = transform_gaussian_blur(mask, scale)
+    if 'mask' in types:
+        with profiling.stage('apply_mask'):
+            outputs['mask'] = pcv.apply_mask(img=img, mask=mask,
+                                             mask_color='white')
+    if 'colors' in types:
+        with profiling.stage('colors'):
+            outputs['colors'] = pcv.analyze_color(rgb_img=img, mask=mask,
+                                                  colorspaces='all',
+                                                  label="default")
+
+    if {'roi', 'analysis', 'pseudolandmarks'} & set(types):
+        with profiling.stage('find_objects'):
+            objects, object_hierarchy = pcv.find_objects(img, mask)
+        if 'roi' in types:
+            with profiling.stage('roi'):
+                outputs['roi'] = render_roi(img, objects, object_hierarchy)
+        if {'analysis', 'pseudolandmarks'} & set(types):
+            with profiling.stage('object_composition'):
+                obj, obj_mask = pcv.object_composition(
+                    img=img, contours=objects, hierarchy=object_hierarchy)
+            if 'analysis' in types:
+                with profiling.stage('analysis'):
+                    outputs['analysis'] = pcv.analyze_object(img, obj,
+                                                             obj_mask)
+            if 'pseudolandmarks' in types:
+                with profiling.stage('pseudolandmarks'):
+                    outputs['pseudolandmarks'] = render_pseudolandmarks(
+                        img, obj, obj_mask)
+
+    # Measurements are never read back, don't let them pile up
+    pcv.outputs.clear()
+    return outputs
+
+
+def transform_image(img_path: str, dst: str, type: str,
+                    separate: bool = False, working_size: int = None) -> list:
+    """
+    Performs the requested image transformations on an image using
+    PlantCV's functions, decoding and masking it only once
     Arguments:
         img_path (string): path to original image
         dst (string): directory where resulting images will be stored
         type (string): type of transformation requested
+        separate (boolean, default: False): store each transformation in
+            its own '{dst}/{type}' directory
+        working_size (int, default: None): side of the square images
+            transformed and written, full resolution when None
+    Returns:
+        A list of the paths of the images written
     """
-    # Initialisation
-    img, path, filename = pcv.readimage(img_path)
-    pcv.params.debug_outdir = dst
-    new_image_prefix = dst + '/'
-    if img_path[0:2] == "./":
-        img_path = img_path[2:]
-    new_image_prefix += img_path[img_path.find('/') + 1:-4]
-    new_image_directory = os.path.split(new_image_prefix)[0]
-    if not os.path.exists(new_image_directory):
-        os.makedirs(new_image_directory)
+    written = []
+    with profiling.stage('transform_image'):
+        with profiling.stage('decode'):
+            img = read_image(img_path, working_size)
+        if img_path[0:2] == "./":
+            img_path = img_path[2:]
+        relative_prefix = img_path[img_path.find('/') + 1:-4]
+
+        outputs = transform_all(img, expand_types(type), working_size)
+        for single_type, transformed in outputs.items():
+            type_dst = f"{dst}/{single_type}" if separate else dst
+            new_image_prefix = type_dst + '/' + relative_prefix
+            new_image_directory = os.path.split(new_image_prefix)[0]
+            os.makedirs(new_image_directory, exist_ok=True)
+            with profiling.stage('encode'):
+                pcv.print_image(transformed,
+                                new_image_prefix + TYPE_SUFFIXES[single_type])
+            written.append(new_image_prefix + TYPE_SUFFIXES[single_type])
+    profiling.count('images')
+    profiling.count('outputs', len(written))
+    return written
+
+
+def list_images(src: str) -> list:
+    """
+    Lists every jpeg image of a directory, including images in
+    sub-directories, from the directory's dataset index
+    Arguments:
+        src (string): path of the directory to list
+    Returns:
+        A list of paths to the jpeg images found
+    """
+    return dataset_index.images(src)
 
-    mask = mask_image(img)
 
-    # Gaussian blur of image
-    if type in ['blur', 'all']:
-        gaussian_blur = transform_gaussian_blur(img)
-        pcv.print_image(gaussian_blur, new_image_prefix + "_BLURRED.JPG")
+def load_manifest(dst: str) -> dict:
+    """
+    Loads the manifest of the images already transformed into a directory.
+    Entries are kept per requested type, so that the outputs of every type
+    transformed into the same directory are tracked side by side
+    Arguments:
+        dst (string): directory where transformed images are stored
+    Returns:
+        A dict mapping each requested type to the manifest entry of each
+        source path
+    """
+    manifest_path = os.path.join(dst, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        print(f"Ignoring unreadable manifest {manifest_path}")
+        return {}
+    if 'types' in manifest:
+        return manifest['types']
+    # Manifests written with a single entry per source
+    types = {}
+    for path, entry in manifest.get('sources', {}).items():
+        types.setdefault(entry.get('type'), {})[path] = entry
+    return types
+
+
+def manifest_working_size(dst: str) -> int:
+    """
+    Finds the working size the images of a transformed directory were made
+    at, so that predictions transform images the same way
+    Arguments:
+        dst (string): directory where transformed images are stored
+    Returns:
+        The working size, None for full resolution or a missing manifest
+    Raises:
+        ValueError: if the images were made at different working sizes
+    """
+    sizes = {entry.get('working_size')
+             for entries in load_manifest(dst).values()
+             for entry in entries.values()}
+    if len(sizes) > 1:
+        raise ValueError(f"{dst} mixes the working sizes {sizes}, transform"
+                         + " it again with a single one")
+    return sizes.pop() if sizes else None
 
-    # Gaussian blur of mask
-    if type in ['maskblur']:
-        mask_blur = transform_gaussian_blur(mask)
-        pcv.print_image(mask_blur, new_image_prefix + "_MASKBLUR.JPG")
 
-    # Masked image
-    if type in ['mask', 'all']:
-        masked = transform_masked(img)
-        pcv.print_image(masked, new_image_prefix + "_MASKED.JPG")
+def save_manifest(dst: str, manifest: dict) -> None:
+    """
+    Atomically writes the manifest of a destination directory, so that an
+    interrupted run can resume from it
+    Arguments:
+        dst (string): directory where transformed images are stored
+        manifest (dict): source path to manifest entry mapping of each
+            requested type, as returned by load_manifest
+    """
+    os.makedirs(dst, exist_ok=True)
+    manifest_path = os.path.join(dst, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'types': manifest}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
-    # ROI objects
-    if type in ['roi', 'all']:
-        roi_img = transform_roi(img, dst=dst)
-        pcv.print_image(roi_img, new_image_prefix + "_ROI_OBJECTS.JPG")
 
-    # Analyse objects
-    if type in ['analysis', 'all']:
-        analyse_img = transform_analysis(img)
-        pcv.print_image(analyse_img, new_image_prefix + "_ANALYZED.JPG")
+def _is_up_to_date(entry: dict, digest: str, type: str,
+                   separate: bool, working_size: int) -> bool:
+    """
+    Checks whether a manifest entry still describes the current outputs
+    Arguments:
+        entry (dict): manifest entry of the source image
+        digest (string): current content hash of the source image
+        type (string): type of transformation requested
+        separate (boolean): transformations stored in separate directories
+        working_size (int): side of the images transformed, or None
+    Returns:
+        True if the source image doesn't need to be transformed again
+    """
+    return (entry.get('sha1') == digest
+            and entry.get('type') == type
+            and entry.get('separate') == separate
+            and entry.get('working_size') == working_size
+            and entry.get('params') == TRANSFORM_PARAMS
+            and all(os.path.isfile(output) for output in entry['outputs']))
 
-    # Pseudolandmarks
-    if type in ['pseudolandmarks', 'all']:
-        pseudo_img = transform_pseudolandmarks(img, dst=dst)
-        pcv.print_image(pseudo_img, new_image_prefix + "_PSEUDOLANDMARKS.JPG")
 
-    # Analyse colors channels
-    if type in ['colors']:
-        color_channels = transform_colors(img)
-        pcv.print_image(color_channels, new_image_prefix + "_COLORS.JPG")
+def _remove_outputs(outputs: list, keep: list = ()) -> None:
+    """
+    Deletes transformed images that are no longer produced
+    Arguments:
+        outputs (list): paths to the previously transformed images
+        keep (list): paths that must not be deleted
+    """
+    for output in outputs:
+        if output not in keep and os.path.isfile(output):
+            os.remove(output)
 
 
-def transform_directory(src: str, dst: str, type: str) -> None:
+def _transform_job(img_path: str, dst: str, type: str,
+                   separate: bool, working_size: int) -> tuple:
+    """
+    Transforms one image of a directory, in a worker process if need be
+    Arguments:
+        img_path (string): path to original image
+        dst (string): directory where resulting images will be stored
+        type (string): type of transformation requested
+        separate (boolean): store each transformation in its own directory
+        working_size (int): side of the images transformed, or None
+    Returns:
+        A (source path, written paths) tuple
+    """
+    return img_path, transform_image(img_path, dst=dst, type=type,
+                                     separate=separate,
+                                     working_size=working_size)
+
+
+def transform_directory(src: str, dst: str, type: str,
+                        workers: int = 1, separate: bool = False,
+                        incremental: bool = True,
+                        working_size: int = None) -> None:
     """
     Performs image transformations on every image of a directory,
-    including images in sub-directories
+    including images in sub-directories. Each image is read once, whatever
+    the number of transformations requested.
+    A manifest of the content hash, type and parameters behind every output
+    is kept in dst for each requested type: up to date images are skipped,
+    outputs of removed sources are pruned and an interrupted run resumes
+    where it stopped. Outputs of the other types are left alone
     Arguments:
         src (string): path of directory where transformations will be applied
         dst (string): directory where resulting images will be stored
         type (string): type of transformation requested
+        workers (int, default: 1): number of processes transforming images
+        separate (boolean, default: False): store each transformation in
+            its own '{dst}/{type}' directory
+        incremental (boolean, default: True): skip up to date images
+        working_size (int, default: None): side of the square images
+            transformed and written, full resolution when None
+    """
+    with profiling.stage('list_images'):
+        images = list_images(src)
+    manifest = load_manifest(dst)
+    entries = manifest.setdefault(type, {})
+
+    # Prune the outputs of sources that disappeared
+    sources = set(images)
+    removed = [path for path in entries if path not in sources]
+    for path in removed:
+        _remove_outputs(entries.pop(path)['outputs'])
+
+    # Only pay for images whose content or requested outputs changed
+    pending = {}
+    with profiling.stage('check_manifest'):
+        for img_path in images:
+            stat = os.stat(img_path)
+            entry = entries.get(img_path, {})
+            if (entry.get('size') == stat.st_size
+               and entry.get('mtime_ns') == stat.st_mtime_ns):
+                digest = entry['sha1']
+            else:
+                digest = dataset_index.file_digest(img_path)
+            if incremental and _is_up_to_date(entry, digest, type, separate,
+                                              working_size):
+                entry['size'] = stat.st_size
+                entry['mtime_ns'] = stat.st_mtime_ns
+                continue
+            pending[img_path] = {'sha1': digest, 'size': stat.st_size,
+                                 'mtime_ns': stat.st_mtime_ns, 'type': type,
+                                 'separate': separate,
+                                 'working_size': working_size,
+                                 'params': TRANSFORM_PARAMS}
+    if len(images) > len(pending) or removed:
+        print(f"Skipping {len(images) - len(pending)} up to date images"
+              + f" and pruning {len(removed)} removed ones in {src}")
+
+    todo = list(pending)
+    job = profiling.wrap(functools.partial(_transform_job, dst=dst,
+                                           type=type, separate=separate,
+                                           working_size=working_size))
+    try:
+        if workers > 1 and len(todo) > 1:
+            with multiprocessing.Pool(min(workers, len(todo)),
+                                      initializer=set_mask_backend,
+                                      initargs=(mask_backend,)) as pool:
+                results = pool.imap_unordered(job, todo, chunksize=4)
+                _report_progress(profiling.merge(results), todo, type,
+                                 manifest, pending, dst)
+        else:
+            _report_progress(profiling.merge(map(job, todo)), todo, type,
+                             manifest, pending, dst)
+    finally:
+        _invalidate_overlaps(manifest, type, pending)
+        save_manifest(dst, manifest)
+
+
+def _invalidate_overlaps(manifest: dict, type: str, pending: dict) -> None:
+    """
+    Marks as stale the entries of other types that list outputs this run
+    rewrote differently, e.g. the blur images of 'all' when only 'blur' was
+    requested at another working size. Outputs rewritten from the same
+    source with the same parameters are identical and stay up to date
+    Arguments:
+        manifest (dict): manifest entries of each type, updated in place
+        type (string): type of transformation requested
+        pending (dict): new manifest entries of the images transformed
+    """
+    # Producing entry of every output written by this run
+    written = {}
+    for path, new in pending.items():
+        entry = manifest[type].get(path, {})
+        if 'outputs' in entry and all(entry.get(key) == value
+                                      for key, value in new.items()):
+            written.update((output, entry) for output in entry['outputs'])
+    if not written:
+        return
+    for other, entries in manifest.items():
+        if other == type:
+            continue
+        for entry in entries.values():
+            for output in entry.get('outputs', []):
+                writer = written.get(output)
+                if writer is not None and any(
+                        entry.get(key) != writer.get(key)
+                        for key in ('sha1', 'working_size', 'params')):
+                    entry['params'] = None
+                    break
+
+
+def _report_progress(results, images: list, type: str, manifest: dict,
+                     pending: dict, dst: str) -> None:
+    """
+    Consumes the transformations of a directory while printing their
+    progress and recording them in the manifest, then sums them up per
+    sub-directory
+    Arguments:
+        results (iterable): lazily computed (source, outputs) tuples
+        images (list): paths to the images being transformed
+        type (string): type of transformation requested
+        manifest (dict): manifest entries of each type, the ones of type
+            being updated in place
+        pending (dict): new manifest entries of the images being transformed
+        dst (string): directory where the manifest is saved
     """
-    file_count = 0
-    dir_content = os.listdir(src)
-    for filename in dir_content:
-        file_path = os.path.join(src, filename)
-        if os.path.isfile(file_path) and (filetype.guess(file_path) is not None
-           and filetype.guess(file_path).extension == 'jpg'):
-            transform_image(img_path=file_path, dst=dst, type=type)
-            file_count += 1
-            print(f"\rApplying {type} to {file_count}/{len(dir_content)}...",
-                  end='',
-                  flush=True)
-        elif os.path.isdir(file_path):
-            transform_directory(src=file_path, dst=dst, type=type)
-    if file_count > 0:
-        print(f"\nApplied {type} to {file_count} JPG files in {src}")
+    entries = manifest[type]
+    for file_count, (img_path, outputs) in enumerate(results, start=1):
+        _remove_outputs(entries.get(img_path, {}).get('outputs', []),
+                        keep=outputs)
+        entries[img_path] = dict(pending[img_path], outputs=outputs)
+        if file_count % 500 == 0:
+            save_manifest(dst, manifest)
+        print(f"\rApplying {type} to {file_count}/{len(images)}...",
+              end='',
+              flush=True)
+    dir_counts = {}
+    for img_path in images:
+        img_dir = os.path.dirname(img_path)
+        dir_counts[img_dir] = dir_counts.get(img_dir, 0) + 1
+    if len(images) > 0:
+        print()
+    for img_dir, file_count in dir_counts.items():
+        print(f"Applied {type} to {file_count} JPG files in {img_dir}")
 
 
 def plot_images(img_path: str, dst: str) -> None:
@@ -235,6 +788,7 @@ def plot_images(img_path: str, dst: str) -> None:
         img_path (str): Path to original image
         dst (str): Destination where the transformations were stored
     """
+    plt = lazy.pyplot()
     # Get the paths to each transformed image
     img_prefix = dst + '/'
     if img_path[0:2] == "./":
@@ -348,8 +902,30 @@ def plot_images(img_path: str, dst: str) -> None:
                    + "'pseudolandmarks', 'colors', 'maskblur']")
 @click.option('--separate', default=True,
               help="Separation of transformations in different directories")
+@click.option('--workers', default=os.cpu_count() or 1,
+              help="Number of processes transforming a directory's images")
+@click.option('--incremental', default=True,
+              help="Skip images already transformed with the same content,"
+                   + " type and parameters")
+@click.option('--mask-backend', default='plantcv',
+              type=click.Choice(MASK_BACKENDS),
+              help="Implementation of the mask, both giving the same pixels")
+@click.option('--headless', is_flag=True,
+              help="Don't plot a single file's transformations, implied when"
+                   + " no display is available or LEAFFLICTION_HEADLESS=1")
+@click.option('--working-size', default=None,
+              type=click.IntRange(min=1),
+              help="Decode and transform images at this square size, e.g."
+                   + " the models' 128, instead of full resolution")
+@click.option('--profile', default=None,
+              help="Write a Chrome trace of the run's stages to this file"
+                   + " and print their timings")
 @click.argument('file', required=False)
-def main(file, src, dst, type, separate) -> None:
+def main(file, src, dst, type, separate, workers, incremental, mask_backend,
+         headless, working_size, profile) -> None:
+    if profile is not None:
+        profiling.enable()
+    set_mask_backend(mask_backend)
     # Check if requested type is acceptable
     known_types = ['all', 'blur', 'mask', 'roi', 'analysis',
                    'pseudolandmarks', 'colors', 'maskblur']
@@ -370,8 +946,11 @@ def main(file, src, dst, type, separate) -> None:
         if img_dir[0:2] == "./":
             img_dir = img_dir[2:]
         img_dir = img_dir[:img_dir.find('/')]
-        transform_image(file, dst=f"./{img_dir}_transformed", type=type)
-        plot_images(file, dst=f"./{img_dir}_transformed")
+        transform_image(file, dst=f"./{img_dir}_transformed", type=type,
+                        working_size=working_size)
+        profiling.finish(profile)
+        if not (headless or lazy.headless()):
+            plot_images(file, dst=f"./{img_dir}_transformed")
     # Directory transformation
     elif (src is not None and dst is not None):
         if os.path.isdir(src) is False:
@@ -379,22 +958,18 @@ def main(file, src, dst, type, separate) -> None:
         if src[-1] == '/':
             src = src[:-1]
         if separate is True:
-            if type == 'all':
-                known_types.remove('all')
-                known_types.remove('maskblur')
-                known_types.remove('colors')
-                for single_type in known_types:
-                    transform_directory(src=src,
-                                        dst=f"{dst}/{src}/{single_type}",
-                                        type=single_type)
-                    print(f"Finished applying {single_type}! Resulting images"
-                          + f" can be found at {dst}/{src}/{single_type}\n")
-            else:
-                transform_directory(src=src,
-                                    dst=f"{dst}/{src}/{type}",
-                                    type=type)
+            transform_directory(src=src, dst=f"{dst}/{src}", type=type,
+                                workers=workers, separate=True,
+                                incremental=incremental,
+                                working_size=working_size)
+            for single_type in expand_types(type):
+                print(f"Finished applying {single_type}! Resulting images"
+                      + f" can be found at {dst}/{src}/{single_type}")
         else:
-            transform_directory(src=src, dst=f"{dst}/{src}", type=type)
+            transform_directory(src=src, dst=f"{dst}/{src}", type=type,
+                                workers=workers, incremental=incremental,
+                                working_size=working_size)
+        profiling.finish(profile)
     # Not enough arguments
     else:
         ctx = click.get_current_context()
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+import click
+
+from utils import dataset_index, ensemble
+
+
+def measure(kind, path, names):
+    """
+    Loads an ensemble and reports the time and memory it took. Meant to run
+    in a fresh process so that imports are accounted for
+    Arguments:
+        kind (str): 'joblib' or 'artifact'
+        path (str): path to the joblib file or to the artifact directory
+        names (list): transformations to load, all of them if empty
+    """
+    start = time.perf_counter()
+    if kind == 'joblib':
+        import joblib
+        models = joblib.load(filename=path)
+    else:
+        models = list(ensemble.load_members(path, names or None))
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'format': kind, 'models': len(models),
+                      'load_s': elapsed, 'peak_rss_mb': peak_rss}))
+
+
+def run_measure(kind, path, names=()):
+    """
+    Measures the loading of an ensemble in a child process
+    Returns:
+        The dict printed by the child process
+    """
+    command = [sys.executable, __file__, '--child', kind, path, *names]
+    start = time.perf_counter()
+    output = subprocess.run(command, check=True, capture_output=True,
+                            text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_s'] = time.perf_counter() - start
+    return result
+
+
+def convert(jl_path, classes_dir):
+    """
+    Converts a joblib ensemble into an ensemble artifact
+    Arguments:
+        jl_path (str): path to the '{dataset}.joblib' file
+        classes_dir (str): dataset directory holding one sub-directory per
+            class
+    Returns:
+        The path to the artifact
+    """
+    import joblib
+    directory = jl_path[:-len('.joblib')]
+    transformations = dataset_index.classes(directory)
+    path = ensemble.artifact_path(directory)
+    ensemble.save_ensemble(path, joblib.load(filename=jl_path),
+                           transformations,
+                           classes=dataset_index.classes(classes_dir),
+                           input_size=[128, 128],
+                           data_hash=dataset_index.fingerprint(directory))
+    return path
+
+
+@click.command()
+@click.option('--convert', 'classes_dir', default=None,
+              help="Convert the joblib ensemble first, using this dataset"
+                   + " directory for the class names")
+@click.argument('jl_path')
+def main(jl_path, classes_dir):
+    """
+    Compares the startup time and resident memory of loading the joblib
+    ensemble JL_PATH against its ensemble artifact
+    """
+    if classes_dir is not None:
+        print(f"Converted to {convert(jl_path, classes_dir)}")
+    path = ensemble.artifact_path(jl_path[:-len('.joblib')])
+    if not os.path.isdir(path):
+        return print(f"{path} not found, use --convert to create it")
+    names = ensemble.load_metadata(path)['transformations']
+    results = [run_measure('joblib', jl_path),
+               run_measure('artifact', path),
+               run_measure('artifact', path, names[:1])]
+    print(f"{'format':<10}{'models':>8}{'load (s)':>10}"
+          + f"{'process (s)':>13}{'peak RSS (MB)':>15}")
+    for result in results:
+        print(f"{result['format']:<10}{result['models']:>8}"
+              + f"{result['load_s']:>10.2f}{result['process_s']:>13.2f}"
+              + f"{result['peak_rss_mb']:>15.0f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == '--child':
+        measure(sys.argv[2], sys.argv[3], sys.argv[4:])
+    else:
+        main()
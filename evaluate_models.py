@@ -1,46 +1,90 @@
 import os
-import sys
-import joblib
-from Train import soft_vote, hard_vote, print_accuracy
+import click
+import numpy as np
+from Train import print_accuracy, make_datasets, StoreSequence
 
-from tensorflow.keras.utils import image_dataset_from_directory
+from utils import dataset_index, ensemble, tensor_store
+from utils.voting import VoteAccumulator
+from utils.evaluation import (predict_with_labels, confusion_matrix,
+                              print_confusion_matrix, print_throughput)
 
 
-def main():
-    # argument
-    if len(sys.argv) != 2:
-        return help()
-    if os.path.isdir(sys.argv[1]) is False:
-        return print("Argument {} is not a directory".format(sys.argv[1]))
+@click.command()
+@click.option('--backend', default='keras',
+              type=click.Choice(ensemble.BACKENDS),
+              help="Run the models with keras or with their TFLite export")
+@click.option('--store', is_flag=True,
+              help="Read the images from the tensor store built by"
+                   + " BuildTensorStore.py instead of decoding them")
+@click.option('--weights', default=None,
+              help="Comma separated soft vote weight of each model, in"
+                   + " transformation order, equal weights by default")
+@click.argument('directory')
+def main(directory, backend, store, weights):
+    """
+    Evaluates the ensemble trained on DIRECTORY on its validation split
+    """
+    if os.path.isdir(directory) is False:
+        return print("Argument {} is not a directory".format(directory))
 
-    fruit = sys.argv[1].split('/', 1)[1]
-    jl_name = os.path.join(sys.argv[1] + '.joblib')
+    fruit = directory.split('/', 1)[1]
+    jl_name = os.path.join(directory + '.joblib')
     data_acc = None
-    predictions_validation = []
-    subdirs = [elt for elt in os.listdir(sys.argv[1]) if fruit not in elt]
-    subdirs = sorted(subdirs)
-    models = joblib.load(filename=jl_name)
-    for (model, subdir) in zip(models, subdirs):
+    subdirs = [elt for elt in dataset_index.classes(directory)
+               if fruit not in elt]
+    if weights is not None:
+        weights = [float(weight) for weight in weights.split(',')]
+        if len(weights) != len(subdirs):
+            return print(f"{len(weights)} weights given for"
+                         + f" {len(subdirs)} models: {subdirs}")
+    # Only the running votes are kept, not every model's predictions
+    votes = VoteAccumulator(weights)
+    model_path = ensemble.artifact_path(directory)
+    if os.path.isdir(model_path):
+        models = ensemble.load_members(model_path, subdirs, backend)
+    elif backend == 'keras':
+        # Only ensembles trained before the artifacts need joblib
+        import joblib
+        models = joblib.load(filename=jl_name)
+    else:
+        return print(f"{model_path} not found, the {backend} backend needs"
+                     + " an exported ensemble artifact")
+    if store:
+        store = tensor_store.open_store(directory)
+        if store is None:
+            return print(f"{tensor_store.store_path(directory)} not found,"
+                         + " run BuildTensorStore.py first")
+    results = {}
+    for i, (model, subdir) in enumerate(zip(models, subdirs)):
         print(f'evaluating {subdir} model')
-        # data preprocessing
-        data = image_dataset_from_directory(
-            os.path.join(sys.argv[1], subdir),
-            validation_split=0.2,    # 0.8 for training, 0.2 for validation
-            subset="both",
-            shuffle=True,
-            seed=42,
-            image_size=(128, 128),   # 4x less memory and time than (256,256)
-        )
-        validation_data = data[1]
-        data_acc = data[1]
+        if store:
+            validation_data = StoreSequence(store, subdir, 'validation',
+                                            False)
+            classes = store.classes
+        else:
+            # data preprocessing, in the same fixed order for every model
+            validation_data = make_datasets(os.path.join(directory,
+                                                         subdir))[1]
+            classes = validation_data.class_names
+        # Labels are collected in the same pass as the predictions
+        results[subdir] = predict_with_labels(model, validation_data,
+                                              votes, i)
+        if data_acc is None:
+            data_acc = results[subdir]['labels']
+        elif not np.array_equal(results[subdir]['labels'], data_acc):
+            return print(f"{subdir} validation images differ from those of"
+                         + f" {subdirs[0]}, votes can't be combined")
 
-        predictions_validation.append(model.predict(validation_data))
-        print()
-
-    soft_vote_predictions = soft_vote(predictions_validation)
-    hard_vote_predictions = hard_vote(predictions_validation)
+    soft_vote_predictions = votes.soft_votes()
+    hard_vote_predictions = votes.hard_votes()
     print_accuracy(data_acc, soft_vote_predictions, "soft")
     print_accuracy(data_acc, hard_vote_predictions, "hard")
+    for mode, predictions in [('soft', soft_vote_predictions),
+                              ('hard', hard_vote_predictions)]:
+        print_confusion_matrix(
+            confusion_matrix(data_acc, predictions, len(classes)), classes,
+            mode)
+    print_throughput(results)
 
 
 if __name__ == "__main__":
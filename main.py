@@ -39,7 +39,7 @@ def main() ->int :
   leafSelect.pack()
 
   #Onglet Analysis / Distribution
-  buttonAnalyse = tk.Button(onglet1, text="Analysis of the Data Set", command=lambda:analysis(leafVar.get(), expVar.get()))
+  buttonAnalyse = tk.Button(onglet1, text="Analysis of the Data Set", command=lambda:analysis(leafVar.get()))
 
   #Onglet Augmentation
   expVar = tk.IntVar(value=0)
@@ -0,0 +1,250 @@
+import os
+import json
+import hashlib
+import fnmatch
+import filetype
+
+
+# Name of the index file persisted at the root of an indexed directory
+INDEX_NAME = '.leaffliction_index.json'
+INDEX_VERSION = 1
+
+# Indexes already refreshed by this process, by absolute root path, along
+# with the mtimes of their directories when they were last checked
+_indexes = {}
+
+
+def _scan(directory: str, rel: str, old_files: dict, index: dict) -> None:
+    """
+    Recursively records the directories and files under a directory,
+    reusing the JPEG verification of files whose size and mtime didn't change
+    Arguments:
+        directory (str): directory being scanned
+        rel (str): path of the directory relative to the index root
+        old_files (dict): files of the previous index
+        index (dict): index being built, updated in place
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.startswith('.') or entry.name == '__pycache__':
+            continue
+        entry_rel = os.path.join(rel, entry.name) if rel else entry.name
+        if entry.is_dir():
+            index['dirs'].append(entry_rel)
+            _scan(entry.path, entry_rel, old_files, index)
+        elif entry.is_file():
+            stat = entry.stat()
+            old = old_files.get(entry_rel)
+            is_jpeg = None
+            if old is not None and old[:2] == [stat.st_size,
+                                               stat.st_mtime_ns]:
+                is_jpeg = old[2]
+            index['files'][entry_rel] = [stat.st_size, stat.st_mtime_ns,
+                                         is_jpeg]
+
+
+def _dir_mtimes(root: str, dirs: list) -> list:
+    """
+    Stamps the directories of an index. A file added, removed or renamed
+    changes the mtime of its directory
+    Arguments:
+        root (str): indexed directory
+        dirs (list): sub-directories of the index, relative to root
+    Returns:
+        A list of the mtime of root and of each sub-directory, None for a
+        missing one
+    """
+    stamps = []
+    for rel in [''] + dirs:
+        try:
+            stamps.append(os.stat(os.path.join(root, rel)).st_mtime_ns)
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+def _remember(root: str, index: dict) -> None:
+    """
+    Keeps an index up to date with the filesystem for this process
+    """
+    _indexes[os.path.abspath(root)] = (_dir_mtimes(root, index['dirs']),
+                                       index)
+
+
+def _save(root: str, index: dict) -> None:
+    """
+    Persists an index at the root of the directory it describes. Read-only
+    directories simply keep their index in memory
+    Arguments:
+        root (str): indexed directory
+        index (dict): index to persist
+    """
+    index_path = os.path.join(root, INDEX_NAME)
+    try:
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(index_path + '.tmp', index_path)
+    except OSError:
+        return
+    # Writing the index changed the mtime of root
+    if os.path.abspath(root) in _indexes:
+        _remember(root, index)
+
+
+def load_index(root: str, refresh: bool = False) -> dict:
+    """
+    Loads the index of a directory, refreshing it against the filesystem the
+    first time it is requested by this process, and again whenever one of
+    its directories changed since
+    Arguments:
+        root (str): indexed directory
+        refresh (boolean, default: False): rescan even if already refreshed
+    Returns:
+        A dict with the relative 'dirs' list and the 'files' dict mapping
+        each relative path to its [size, mtime_ns, is_jpeg] record
+    """
+    cached = _indexes.get(os.path.abspath(root))
+    if (cached is not None and not refresh
+       and cached[0] == _dir_mtimes(root, cached[1]['dirs'])):
+        return cached[1]
+    old = {'files': {}}
+    try:
+        with open(os.path.join(root, INDEX_NAME)) as f:
+            old = json.load(f)
+        if old.get('version') != INDEX_VERSION:
+            old = {'files': {}}
+    except (OSError, ValueError):
+        pass
+    index = {'version': INDEX_VERSION, 'dirs': [], 'files': {}}
+    _scan(root, '', old['files'], index)
+    index['dirs'].sort()
+    _remember(root, index)
+    if index != old:
+        _save(root, index)
+    return index
+
+
+def _verify_jpegs(root: str, index: dict) -> None:
+    """
+    Sniffs the type of the files whose JPEG status isn't known yet, so that
+    every file is read at most once until it changes
+    Arguments:
+        root (str): indexed directory
+        index (dict): index of the directory, updated in place
+    """
+    changed = False
+    for rel, record in index['files'].items():
+        if record[2] is None:
+            kind = filetype.guess(os.path.join(root, rel))
+            record[2] = kind is not None and kind.extension == 'jpg'
+            changed = True
+    if changed:
+        _save(root, index)
+
+
+def images(root: str, subdir: str = None) -> list:
+    """
+    Lists the verified JPEG images of an indexed directory
+    Arguments:
+        root (str): indexed directory
+        subdir (str, default: None): only list images under this
+            sub-directory of root
+    Returns:
+        A sorted list of paths, joined to root as it was given
+    """
+    index = load_index(root)
+    _verify_jpegs(root, index)
+    prefix = os.path.join(subdir, '') if subdir else ''
+    return sorted(os.path.join(root, rel)
+                  for rel, record in index['files'].items()
+                  if record[2] and rel.startswith(prefix))
+
+
+def classes(root: str) -> list:
+    """
+    Lists the direct sub-directories of an indexed directory, i.e. its
+    classes for a dataset or its transformations for a transformed dataset
+    Arguments:
+        root (str): indexed directory
+    Returns:
+        A sorted list of sub-directory names
+    """
+    return [rel for rel in load_index(root)['dirs'] if os.sep not in rel]
+
+
+def class_counts(root: str) -> dict:
+    """
+    Counts the files directly inside each class of an indexed directory
+    Arguments:
+        root (str): indexed directory
+    Returns:
+        A dict mapping each class to its number of files
+    """
+    counts = {name: 0 for name in classes(root)}
+    for rel in load_index(root)['files']:
+        parts = rel.split(os.sep)
+        if len(parts) == 2:
+            counts[parts[0]] += 1
+    return counts
+
+
+def stray_files(root: str) -> list:
+    """
+    Lists the files lying directly at the root of an indexed directory
+    Arguments:
+        root (str): indexed directory
+    Returns:
+        A sorted list of paths, joined to root as it was given
+    """
+    return sorted(os.path.join(root, rel) for rel in load_index(root)['files']
+                  if os.sep not in rel)
+
+
+def find(root: str, pattern: str, dirs: bool = False) -> str:
+    """
+    Finds the file whose name matches the requested pattern
+    Arguments:
+        root (str): indexed directory where the file must be searched
+        pattern (str): requested pattern
+        dirs (boolean, default: False): search directories instead of files
+    Returns:
+        Complete path to the file, or None if file wasn't found
+    """
+    index = load_index(root)
+    for rel in (index['dirs'] if dirs else sorted(index['files'])):
+        if fnmatch.fnmatch(os.path.basename(rel), pattern):
+            return os.path.join(root, rel)
+    return None
+
+
+def fingerprint(root: str) -> str:
+    """
+    Hashes the listing of an indexed directory, i.e. the path, size and
+    mtime of every file, without reading any file
+    Arguments:
+        root (str): indexed directory
+    Returns:
+        The hexadecimal sha1 digest of the directory's listing
+    """
+    digest = hashlib.sha1()
+    for rel, record in sorted(load_index(root)['files'].items()):
+        digest.update(f'{rel}\0{record[0]}\0{record[1]}\n'.encode())
+    return digest.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """
+    Computes the content hash of a file
+    Arguments:
+        path (str): path to the file
+    Returns:
+        The hexadecimal sha1 digest of the file's content
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
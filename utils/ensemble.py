@@ -0,0 +1,240 @@
+import os
+import json
+import functools
+import numpy as np
+
+
+# Suffix of the directory holding a trained ensemble
+ARTIFACT_SUFFIX = '.model'
+METADATA_NAME = 'metadata.json'
+FORMAT_VERSION = 1
+# Backends able to run the members of an ensemble
+BACKENDS = ['keras', 'tflite']
+# Metadata entries of the exports built from the members by Export.py
+EXPORTS = ['tflite', 'fused']
+
+
+def artifact_path(directory: str) -> str:
+    """
+    Gives the artifact path of the ensemble trained on a directory
+    Arguments:
+        directory (str): transformed dataset the ensemble is trained on
+    Returns:
+        The path of the ensemble's directory
+    """
+    return directory.rstrip('/') + ARTIFACT_SUFFIX
+
+
+def member_file(name: str, backend: str = 'keras') -> str:
+    """
+    Gives the file name of the model trained on a transformation
+    Arguments:
+        name (str): transformation the model was trained on
+        backend (str, default: 'keras'): format of the model
+    """
+    return f'{name}.keras' if backend == 'keras' else f'{name}.tflite'
+
+
+def write_metadata(path: str, **fields) -> dict:
+    """
+    Writes or updates the metadata of an ensemble artifact
+    Arguments:
+        path (str): directory of the ensemble
+        fields: metadata entries to set, e.g. classes, transformations,
+            input_size, working_size or data_hash
+    Returns:
+        The complete metadata
+    """
+    os.makedirs(path, exist_ok=True)
+    metadata = {'format_version': FORMAT_VERSION}
+    if os.path.isfile(os.path.join(path, METADATA_NAME)):
+        metadata = load_metadata(path)
+    metadata.update(fields)
+    with open(os.path.join(path, METADATA_NAME), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def load_metadata(path: str) -> dict:
+    """
+    Loads the metadata of an ensemble artifact, without loading any model
+    Arguments:
+        path (str): directory of the ensemble
+    Returns:
+        A dict holding the classes, transformations, input size and
+        training data hash of the ensemble
+    """
+    with open(os.path.join(path, METADATA_NAME)) as f:
+        return json.load(f)
+
+
+def clear_exports(path: str, transformations: list = None) -> None:
+    """
+    Deletes the TFLite and fused exports of an ensemble and removes them
+    from its metadata, as retraining its members outdates them. Members of
+    transformations no longer trained are deleted along with them
+    Arguments:
+        path (str): directory of the ensemble
+        transformations (list, default: None): transformations about to be
+            trained, every member is kept when None
+    """
+    if not os.path.isfile(os.path.join(path, METADATA_NAME)):
+        return
+    metadata = load_metadata(path)
+    files = [entry for entry in os.listdir(path)
+             if entry.endswith('.tflite')]
+    if isinstance(metadata.get('fused'), dict):
+        files.append(metadata['fused']['file'])
+    if transformations is not None:
+        kept = {member_file(name) for name in transformations}
+        files += [entry for entry in os.listdir(path)
+                  if entry.endswith('.keras') and entry not in kept]
+        metadata['transformations'] = [
+            name for name in metadata.get('transformations', [])
+            if name in transformations]
+    for file in set(files):
+        if os.path.isfile(os.path.join(path, file)):
+            os.remove(os.path.join(path, file))
+    with open(os.path.join(path, METADATA_NAME), 'w') as f:
+        json.dump({key: value for key, value in metadata.items()
+                   if key not in EXPORTS}, f, indent=2)
+
+
+def save_member(path: str, name: str, model) -> None:
+    """
+    Saves the model of one transformation in its native Keras format
+    Arguments:
+        path (str): directory of the ensemble
+        name (str): transformation the model was trained on
+        model (keras.Model): trained model
+    """
+    os.makedirs(path, exist_ok=True)
+    model.save(os.path.join(path, member_file(name)))
+
+
+def save_ensemble(path: str, models: list, transformations: list,
+                  **fields) -> dict:
+    """
+    Saves every model of an ensemble along with its metadata
+    Arguments:
+        path (str): directory of the ensemble
+        models (list): trained models, in transformation order
+        transformations (list): transformation of each model
+        fields: other metadata entries
+    Returns:
+        The complete metadata
+    """
+    for name, model in zip(transformations, models):
+        save_member(path, name, model)
+    return write_metadata(path, transformations=list(transformations),
+                          **fields)
+
+
+class TFLiteMember:
+    """
+    Runs an exported TFLite model with the predict methods of a keras.Model
+    """
+
+    def __init__(self, model_path: str):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=model_path)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def predict_on_batch(self, batch):
+        """
+        Arguments:
+            batch (np.ndarray): (batch_size, height, width, channels) inputs
+        Returns:
+            A (batch_size, classes) np.ndarray of probabilities
+        """
+        batch = np.asarray(batch, dtype=self.input['dtype'])
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'],
+                                                 batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self.input['index'], batch)
+        self.interpreter.invoke()
+        return np.copy(self.interpreter.get_tensor(self.output['index']))
+
+    def predict(self, data, verbose=0):
+        """
+        Arguments:
+            data (np.ndarray or iterable): inputs, or batches of inputs
+                optionally paired with their labels
+        Returns:
+            A (samples, classes) np.ndarray of probabilities
+        """
+        if isinstance(data, np.ndarray):
+            return self.predict_on_batch(data)
+        predictions = []
+        for batch in data:
+            if isinstance(batch, tuple):
+                batch = batch[0]
+            predictions.append(self.predict_on_batch(np.asarray(batch)))
+        return np.concatenate(predictions, axis=0)
+
+
+@functools.lru_cache(maxsize=None)
+def load_member(path: str, name: str, backend: str = 'keras'):
+    """
+    Loads the model of one transformation, once per process
+    Arguments:
+        path (str): directory of the ensemble
+        name (str): transformation the model was trained on
+        backend (str, default: 'keras'): 'keras' or 'tflite'
+    Returns:
+        The keras.Model, or a TFLiteMember for the tflite backend
+    """
+    if backend == 'tflite':
+        return TFLiteMember(os.path.join(path, member_file(name, backend)))
+    from tensorflow import keras
+    return keras.models.load_model(os.path.join(path, member_file(name)))
+
+
+class LazyMembers:
+    """
+    Sequence of the models of an ensemble, each loaded on first access
+    """
+
+    def __init__(self, path: str, names: list, backend: str = 'keras'):
+        self.path = path
+        self.names = list(names)
+        self.backend = backend
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return load_member(self.path, self.names[i], self.backend)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def load_members(path: str, names: list = None,
+                 backend: str = 'keras') -> LazyMembers:
+    """
+    Gives lazy access to the models of an ensemble
+    Arguments:
+        path (str): directory of the ensemble
+        names (list, default: None): transformations to expose, all of them
+            by default
+        backend (str, default: 'keras'): 'keras', or 'tflite' once the
+            ensemble was exported with Export.py
+    Returns:
+        A LazyMembers sequence, in the requested transformation order
+    """
+    if names is None:
+        names = load_metadata(path)['transformations']
+    if backend == 'tflite' and 'tflite' not in load_metadata(path):
+        raise FileNotFoundError(f"{path} wasn't exported to tflite,"
+                                + " run Export.py first")
+    return LazyMembers(path, names, backend)
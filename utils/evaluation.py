@@ -0,0 +1,92 @@
+import time
+import numpy as np
+
+
+def predict_with_labels(model, data, votes=None, index=0) -> dict:
+    """
+    Predicts every batch of a dataset and collects its labels in the same
+    pass, so that both stay aligned even when the dataset reshuffles at
+    each iteration, and the images are only decoded once
+    Arguments:
+        model: keras.Model or TFLiteMember, anything with predict_on_batch
+        data (iterable): batches of (images, labels), e.g. a tf.data.Dataset
+            or a keras Sequence
+        votes (VoteAccumulator, default: None): accumulator the predictions
+            are added to as they come, instead of being kept
+        index (int, default: 0): index of the model in the ensemble
+    Returns:
+        A dict with the 'predictions' (None when accumulated into votes),
+        the 'labels', the number of 'images' and the 'seconds' it took
+    """
+    predictions, labels = [], []
+    start = time.perf_counter()
+    count = 0
+    batches = data
+    if hasattr(data, '__getitem__') and hasattr(data, '__len__'):
+        # keras Sequence, indexed batch by batch
+        batches = (data[i] for i in range(len(data)))
+    for images, batch_labels in batches:
+        prediction = np.asarray(model.predict_on_batch(images))
+        if votes is not None:
+            votes.add(prediction, index, count)
+        else:
+            predictions.append(prediction)
+        labels.append(np.asarray(batch_labels))
+        count += len(prediction)
+    return {'predictions': (np.concatenate(predictions)
+                            if votes is None and predictions else None),
+            'labels': np.concatenate(labels) if labels else np.array([]),
+            'images': count,
+            'seconds': time.perf_counter() - start}
+
+
+def confusion_matrix(labels, predictions, num_classes: int) -> np.ndarray:
+    """
+    Counts the predictions of each true class
+    Arguments:
+        labels (np.ndarray): true class of every sample
+        predictions (np.ndarray): predicted class of every sample
+        num_classes (int): number of classes
+    Returns:
+        A (num_classes, num_classes) np.ndarray, rows being true classes and
+        columns predicted ones
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    predictions = np.asarray(predictions, dtype=np.int64)
+    return np.bincount(labels * num_classes + predictions,
+                       minlength=num_classes ** 2).reshape(num_classes,
+                                                           num_classes)
+
+
+def print_confusion_matrix(matrix: np.ndarray, classes: list,
+                           mode: str = "soft") -> None:
+    """
+    Prints a confusion matrix along with the recall of each class
+    Arguments:
+        matrix (np.ndarray): result of confusion_matrix
+        classes (list): name of each class
+        mode (str, default: "soft"): vote the predictions come from
+    """
+    width = max(8, max(len(name) for name in classes) + 2)
+    print(f"\nConfusion matrix, {mode} vote (rows: true, columns: predicted)")
+    print(' ' * width + ''.join(f'{name[-width + 2:]:>{width}}'
+                                for name in classes) + f"{'recall':>9}")
+    for name, row in zip(classes, matrix):
+        recall = row[classes.index(name)] / row.sum() if row.sum() else 0.0
+        print(f'{name[-width + 2:]:<{width}}'
+              + ''.join(f'{count:>{width}}' for count in row)
+              + f'{recall:>9.3f}')
+
+
+def print_throughput(results: dict) -> None:
+    """
+    Prints the prediction throughput of every model
+    Arguments:
+        results (dict): predict_with_labels result of each model, by name
+    """
+    print(f"\n{'model':<17}{'images':>8}{'seconds':>10}{'images/s':>10}")
+    for name, result in results.items():
+        rate = (result['images'] / result['seconds'] if result['seconds']
+                else float('nan'))
+        print(f"{name:<17}{result['images']:>8}{result['seconds']:>10.2f}"
+              + f"{rate:>10.1f}")
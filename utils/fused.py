@@ -0,0 +1,119 @@
+import os
+
+import tensorflow as tf
+from tensorflow import keras
+
+from utils import ensemble
+
+
+# File of the fused model inside an ensemble artifact
+FUSED_NAME = 'fused.keras'
+
+
+@keras.utils.register_keras_serializable(package='leaffliction')
+class SoftVote(keras.layers.Layer):
+    """
+    Averages the probabilities of every member, optionally weighted
+    """
+
+    def __init__(self, weights=None, **kwargs):
+        super().__init__(**kwargs)
+        self.member_weights = weights
+
+    def call(self, inputs):
+        stacked = tf.stack(inputs, axis=1)
+        if self.member_weights is None:
+            return tf.reduce_mean(stacked, axis=1)
+        weights = tf.constant(self.member_weights, dtype=stacked.dtype)
+        weights = weights / tf.reduce_sum(weights)
+        return tf.einsum('bmc,m->bc', stacked, weights)
+
+    def get_config(self):
+        return dict(super().get_config(), weights=self.member_weights)
+
+
+@keras.utils.register_keras_serializable(package='leaffliction')
+class ArgMax(keras.layers.Layer):
+    """
+    Gives the index of the most probable class
+    """
+
+    def call(self, inputs):
+        return tf.argmax(inputs, axis=-1)
+
+
+@keras.utils.register_keras_serializable(package='leaffliction')
+class HardVote(keras.layers.Layer):
+    """
+    Picks the class of the single most confident member prediction
+    """
+
+    def call(self, inputs):
+        concatenated = tf.concat(inputs, axis=-1)
+        n_classes = tf.shape(inputs[0], out_type=tf.int64)[-1]
+        return tf.math.floormod(tf.argmax(concatenated, axis=-1), n_classes)
+
+
+@keras.utils.register_keras_serializable(package='leaffliction')
+class MaxConfidence(keras.layers.Layer):
+    """
+    Gives the probability behind the hard vote
+    """
+
+    def call(self, inputs):
+        return tf.reduce_max(tf.stack(inputs, axis=1), axis=[1, 2])
+
+
+def build_fused_model(path, weights=None):
+    """
+    Compiles the members of an ensemble into one multi-input model whose
+    outputs already contain the votes
+    Arguments:
+        path (str): directory of the ensemble
+        weights (list, default: None): soft vote weight of each member
+    Returns:
+        A keras.Model taking one input per transformation, named after it,
+        and returning the 'probabilities', 'soft_vote', 'hard_vote' and
+        'hard_confidence'
+    """
+    metadata = ensemble.load_metadata(path)
+    height, width = metadata['input_size']
+    inputs, predictions = [], []
+    for name in metadata['transformations']:
+        member = ensemble.load_member(path, name)
+        # Nesting keeps layer names unique whatever the members were named
+        wrapper = keras.Sequential([member], name=f'{name}_member')
+        inputs.append(keras.Input((height, width, 3), name=name))
+        predictions.append(wrapper(inputs[-1]))
+    probabilities = SoftVote(weights, name='probabilities')(predictions)
+    soft_vote = ArgMax(name='soft_vote')(probabilities)
+    hard_vote = HardVote(name='hard_vote')(predictions)
+    hard_confidence = MaxConfidence(name='hard_confidence')(predictions)
+    return keras.Model(inputs, {'probabilities': probabilities,
+                                'soft_vote': soft_vote,
+                                'hard_vote': hard_vote,
+                                'hard_confidence': hard_confidence},
+                       name='fused_ensemble')
+
+
+def save_fused_model(path, weights=None):
+    """
+    Builds the fused model of an ensemble and saves it in the artifact
+    Arguments:
+        path (str): directory of the ensemble
+        weights (list, default: None): soft vote weight of each member
+    """
+    build_fused_model(path, weights).save(os.path.join(path, FUSED_NAME))
+    ensemble.write_metadata(path, fused={'file': FUSED_NAME,
+                                         'weights': weights})
+
+
+def load_fused_model(path):
+    """
+    Loads the fused model of an ensemble
+    Arguments:
+        path (str): directory of the ensemble
+    Returns:
+        The keras.Model saved by save_fused_model
+    """
+    return keras.models.load_model(os.path.join(path, FUSED_NAME))
@@ -0,0 +1,56 @@
+import os
+import sys
+import importlib.util
+
+
+def lazy_import(name: str):
+    """
+    Imports a module only when one of its attributes is first used, so that
+    command line runs that never need it don't pay for it. The parent
+    packages of a dotted name are imported right away
+    Arguments:
+        name (str): absolute name of the module, e.g. 'plantcv.plantcv'
+    Returns:
+        The module, loaded on first attribute access
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def headless() -> bool:
+    """
+    Returns:
+        True when plots must not be shown: LEAFFLICTION_HEADLESS is set to
+        1, or no display is available, as in cron jobs or ssh sessions
+    """
+    flag = os.environ.get('LEAFFLICTION_HEADLESS', '')
+    if flag.lower() in ('1', 'true', 'yes'):
+        return True
+    return (sys.platform.startswith('linux')
+            and not os.environ.get('DISPLAY')
+            and not os.environ.get('WAYLAND_DISPLAY'))
+
+
+def pyplot():
+    """
+    Imports matplotlib.pyplot when a plot is first drawn. Without a display,
+    the non-interactive Agg backend is selected up front instead of letting
+    matplotlib probe every GUI toolkit
+    Returns:
+        The matplotlib.pyplot module
+    """
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        if headless() and 'MPLBACKEND' not in os.environ:
+            matplotlib.use('Agg')
+    import matplotlib.pyplot
+    return matplotlib.pyplot
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+# Profiler of this process, None while profiling is disabled
+_profiler = None
+
+
+class Profiler:
+    """
+    Records nested stage timings and counters of one process
+    """
+
+    def __init__(self):
+        self.origin = self.now()
+        self.pid = os.getpid()
+        self.events = []
+        self.counters = {}
+        self.local = threading.local()
+
+    @staticmethod
+    def now() -> float:
+        """
+        Returns:
+            The monotonic clock in microseconds, shared by every process of
+            the machine so that worker events line up
+        """
+        return time.perf_counter() * 1e6
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = '/'.join(stack)
+        start = self.now()
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.events.append({'name': name, 'ph': 'X', 'ts': start,
+                                'dur': self.now() - start,
+                                'pid': os.getpid(),
+                                'tid': threading.get_ident(),
+                                'args': {'path': path}})
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.events.append({'name': name, 'ph': 'C', 'ts': self.now(),
+                            'pid': os.getpid(),
+                            'args': {name: self.counters[name]}})
+
+    def drain(self) -> tuple:
+        """
+        Hands over the events and counters recorded so far, so that a worker
+        process can send them back with its result
+        """
+        drained = self.events, self.counters
+        self.events, self.counters = [], {}
+        return drained
+
+
+def enable() -> None:
+    """
+    Starts profiling this process. A forked worker starts afresh instead of
+    carrying on with the events of its parent
+    """
+    global _profiler
+    if _profiler is None or _profiler.pid != os.getpid():
+        _profiler = Profiler()
+
+
+def enabled() -> bool:
+    return _profiler is not None
+
+
+def stage(name: str):
+    """
+    Times a block of code as a stage, nested in the stage it runs in
+    Arguments:
+        name (str): name of the stage
+    Returns:
+        A context manager, doing nothing while profiling is disabled
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Adds to a counter, e.g. the number of images or bytes processed
+    """
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+class _Profiled:
+    """
+    Picklable wrapper profiling a function in a worker process and sending
+    the recorded events back along with its result
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        enable()
+        result = self.function(*args, **kwargs)
+        return result, _profiler.drain()
+
+
+def wrap(function):
+    """
+    Makes a function given to a process pool profile itself in the worker
+    while this process is profiled
+    Returns:
+        The function itself while profiling is disabled
+    """
+    return _Profiled(function) if _profiler is not None else function
+
+
+def unwrap(result):
+    """
+    Merges the events a wrapped function sent back into this process
+    Arguments:
+        result: return value of a function made by wrap
+    Returns:
+        The return value of the original function
+    """
+    if _profiler is None:
+        return result
+    result, (events, counters) = result
+    _profiler.events.extend(events)
+    for name, value in counters.items():
+        _profiler.counters[name] = _profiler.counters.get(name, 0) + value
+    return result
+
+
+def merge(results):
+    """
+    Unwraps lazily the results of a wrapped function mapped over a pool
+    """
+    if _profiler is None:
+        return results
+    return (unwrap(result) for result in results)
+
+
+def summary() -> list:
+    """
+    Aggregates the stages recorded in every process by nesting path
+    Returns:
+        A list of (path, calls, total ms, mean ms, max ms) tuples, in the
+        order each stage first started
+    """
+    stages = {}
+    for event in sorted(_profiler.events, key=lambda event: event['ts']):
+        if event['ph'] == 'X':
+            stages.setdefault(event['args']['path'], []).append(
+                event['dur'] / 1000)
+    return [(path, len(times), sum(times), sum(times) / len(times),
+             max(times)) for path, times in stages.items()]
+
+
+def write_trace(path: str) -> None:
+    """
+    Writes the recorded events in Chrome trace-event JSON, to be opened in
+    chrome://tracing or Perfetto
+    Arguments:
+        path (str): path of the trace file
+    """
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': _profiler.events,
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def print_summary() -> None:
+    """
+    Prints the time spent in each stage, nested stages being indented, and
+    the final value of each counter
+    """
+    wall = (_profiler.now() - _profiler.origin) / 1000
+    print(f"\n{'stage':<40}{'calls':>8}{'total (ms)':>12}{'mean (ms)':>11}"
+          + f"{'max (ms)':>10}{'% wall':>8}")
+    for path, calls, total, mean, longest in summary():
+        depth = path.count('/')
+        name = '  ' * depth + path.rsplit('/', 1)[-1]
+        print(f"{name:<40}{calls:>8}{total:>12.1f}{mean:>11.2f}"
+              + f"{longest:>10.1f}{100 * total / wall:>8.1f}")
+    for name, value in _profiler.counters.items():
+        print(f"{name:<40}{value:>8}")
+    print(f"Wall time: {wall:.1f} ms, stages of worker processes overlap")
+
+
+def finish(path: str) -> None:
+    """
+    Writes the trace and prints the summary of a profiled run
+    Arguments:
+        path (str): path of the trace file, nothing is done if None
+    """
+    if path is None or _profiler is None:
+        return
+    write_trace(path)
+    print_summary()
+    print(f"Trace written to {path}")
@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+import numpy as np
+
+from utils import dataset_index
+
+
+# Suffix of the directory holding the tensor store of a transformed dataset
+STORE_SUFFIX = '.store'
+METADATA_NAME = 'metadata.json'
+FORMAT_VERSION = 1
+# Values of split.npy
+SUBSETS = ['training', 'validation']
+
+
+def store_path(directory: str) -> str:
+    """
+    Gives the path of the tensor store of a transformed dataset
+    Arguments:
+        directory (str): transformed dataset holding one sub-directory per
+            transformation
+    Returns:
+        The path of the store's directory
+    """
+    return directory.rstrip('/') + STORE_SUFFIX
+
+
+def shard_file(name: str, shard: int) -> str:
+    """
+    Gives the file name of one shard of a transformation's images
+    """
+    return f'{name}_{shard:03d}.npy'
+
+
+def source_key(rel: str, suffix: str) -> str:
+    """
+    Gives the source image a transformed image was made from, so that the
+    images of every transformation can be aligned row by row
+    Arguments:
+        rel (str): path of the transformed image relative to its
+            transformation's directory
+        suffix (str): suffix appended by the transformation
+    """
+    return rel[:-len(suffix)] if rel.endswith(suffix) else rel
+
+
+def assign_split(key: str, validation_split: float) -> int:
+    """
+    Assigns a source image to a subset from the hash of its path, so that a
+    given image stays in the same subset across rebuilds
+    Returns:
+        The index of the subset in SUBSETS
+    """
+    bucket = int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) / 2 ** 32
+    return int(bucket < validation_split)
+
+
+def decode(path: str, size: int) -> np.ndarray:
+    """
+    Decodes an image as a (size, size, 3) RGB uint8 array
+    """
+    import cv2
+    img = cv2.resize(cv2.imread(path), (size, size),
+                     interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def _decode_job(job: tuple) -> np.ndarray:
+    return decode(*job)
+
+
+def build_store(directory: str, suffixes: dict, size: int = 128,
+                validation_split: float = 0.2, shard_size: int = 2048,
+                workers: int = 1) -> dict:
+    """
+    Decodes every image of a transformed dataset once into memory-mappable
+    .npy shards of fixed-shape uint8 arrays. Row i of every transformation
+    comes from the same source image, whose label and subset are row i of
+    labels.npy and split.npy
+    Arguments:
+        directory (str): transformed dataset holding one sub-directory per
+            transformation, each holding one sub-directory per class
+        suffixes (dict): suffix appended by each transformation
+        size (int, default: 128): height and width of the stored images
+        validation_split (float, default: 0.2): share of validation images
+        shard_size (int, default: 2048): images per shard file
+        workers (int, default: 1): processes decoding the images
+    Returns:
+        The metadata of the store
+    """
+    fruit = os.path.basename(directory.rstrip('/'))
+    transformations = [name for name in dataset_index.classes(directory)
+                       if fruit not in name]
+    rows = {}
+    for name in transformations:
+        suffix = suffixes.get(name, '')
+        prefix = os.path.join(directory, name, '')
+        rows[name] = {source_key(path[len(prefix):], suffix): path
+                      for path in dataset_index.images(directory, name)}
+    # Only images transformed every way can feed the whole ensemble
+    keys = sorted(set.intersection(*(set(r) for r in rows.values())))
+    dropped = max(len(r) for r in rows.values()) - len(keys)
+    if dropped:
+        print(f"Skipping {dropped} images missing from some transformation")
+    classes = sorted({key.split(os.sep, 1)[0] for key in keys})
+
+    path = store_path(directory)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'labels.npy'),
+            np.array([classes.index(key.split(os.sep, 1)[0])
+                      for key in keys], dtype=np.int32))
+    np.save(os.path.join(tmp, 'split.npy'),
+            np.array([assign_split(key, validation_split) for key in keys],
+                     dtype=np.uint8))
+    with multiprocessing.Pool(max(1, workers)) as pool:
+        for name in transformations:
+            print(f"Storing {len(keys)} {name} images")
+            for shard, start in enumerate(range(0, len(keys), shard_size)):
+                chunk = keys[start:start + shard_size]
+                array = np.lib.format.open_memmap(
+                    os.path.join(tmp, shard_file(name, shard)), mode='w+',
+                    dtype=np.uint8, shape=(len(chunk), size, size, 3))
+                jobs = [(rows[name][key], size) for key in chunk]
+                for i, img in enumerate(pool.imap(_decode_job, jobs,
+                                                  chunksize=16)):
+                    array[i] = img
+                array.flush()
+                del array
+    metadata = {'format_version': FORMAT_VERSION,
+                'transformations': transformations, 'classes': classes,
+                'size': size, 'rows': len(keys), 'shard_size': shard_size,
+                'validation_split': validation_split,
+                'data_hash': dataset_index.fingerprint(directory)}
+    with open(os.path.join(tmp, METADATA_NAME), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return metadata
+
+
+class TensorStore:
+    """
+    Read-only view of a tensor store. Arrays are memory-mapped, so
+    processes reading the same store share its pages through the OS cache
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, METADATA_NAME)) as f:
+            self.metadata = json.load(f)
+        self.classes = self.metadata['classes']
+        self.shard_size = self.metadata['shard_size']
+        self.labels = np.load(os.path.join(path, 'labels.npy'),
+                              mmap_mode='r')
+        self.split = np.load(os.path.join(path, 'split.npy'), mmap_mode='r')
+        self._shards = {}
+
+    def shards(self, name: str) -> list:
+        """
+        Returns:
+            The memory-mapped shards of a transformation's images
+        """
+        if name not in self._shards:
+            count = -(-self.metadata['rows'] // self.shard_size)
+            self._shards[name] = [
+                np.load(os.path.join(self.path, shard_file(name, shard)),
+                        mmap_mode='r')
+                for shard in range(count)]
+        return self._shards[name]
+
+    def indices(self, subset: str) -> np.ndarray:
+        """
+        Returns:
+            The sorted rows of a subset, 'training' or 'validation'
+        """
+        return np.flatnonzero(self.split == SUBSETS.index(subset))
+
+    def take(self, name: str, rows: np.ndarray) -> np.ndarray:
+        """
+        Gathers rows of a transformation's images
+        Arguments:
+            name (str): transformation
+            rows (np.ndarray): rows to gather, sorted rows reading the
+                shards sequentially
+        Returns:
+            A (len(rows), size, size, 3) uint8 np.ndarray
+        """
+        rows = np.asarray(rows)
+        size = self.metadata['size']
+        images = np.empty((len(rows), size, size, 3), dtype=np.uint8)
+        shard_of = rows // self.shard_size
+        for shard in np.unique(shard_of):
+            mask = shard_of == shard
+            images[mask] = self.shards(name)[shard][
+                rows[mask] - shard * self.shard_size]
+        return images
+
+    def is_stale(self, directory: str) -> bool:
+        """
+        Checks whether a transformed dataset changed since the store was
+        built from it
+        """
+        return self.metadata['data_hash'] != dataset_index.fingerprint(
+            directory)
+
+
+def open_store(directory: str) -> TensorStore:
+    """
+    Opens the tensor store of a transformed dataset
+    Arguments:
+        directory (str): transformed dataset the store was built from
+    Returns:
+        A TensorStore, or None if the store wasn't built
+    """
+    path = store_path(directory)
+    if not os.path.isfile(os.path.join(path, METADATA_NAME)):
+        return None
+    store = TensorStore(path)
+    if store.is_stale(directory):
+        print(f"Warning: {directory} changed since {path} was built,"
+              + " run BuildTensorStore.py again")
+    return store
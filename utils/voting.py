@@ -0,0 +1,154 @@
+import numpy as np
+
+
+def _stack(predictions) -> np.ndarray:
+    """
+    Stacks the predictions of every model
+    Arguments:
+        predictions (list or np.ndarray): (num_samples, num_classes)
+            probabilities of each model, or their
+            (num_models, num_samples, num_classes) stack
+    Returns:
+        A (num_models, num_samples, num_classes) np.ndarray
+    """
+    if isinstance(predictions, np.ndarray) and predictions.ndim == 3:
+        return predictions
+    return np.stack([np.asarray(p) for p in predictions])
+
+
+def soft_probabilities(predictions, weights=None) -> np.ndarray:
+    """
+    Averages the probabilities of every model, optionally weighted
+    Arguments:
+        predictions (list or np.ndarray): probabilities of each model
+        weights (list, default: None): weight of each model, equal weights
+            when None
+    Returns:
+        A (num_samples, num_classes) np.ndarray of averaged probabilities
+    """
+    return np.average(_stack(predictions), axis=0, weights=weights)
+
+
+def soft_vote(predictions, weights=None) -> np.ndarray:
+    """
+    Picks the class of highest average probability (soft vote)
+    Arguments:
+        predictions (list or np.ndarray): probabilities of each model
+        weights (list, default: None): weight of each model
+    Returns:
+        A (num_samples,) np.ndarray of class indices
+    """
+    return np.argmax(soft_probabilities(predictions, weights), axis=-1)
+
+
+def hard_vote(predictions) -> np.ndarray:
+    """
+    Picks the class of the single most confident model prediction (hard
+    vote), the first model winning ties
+    Arguments:
+        predictions (list or np.ndarray): probabilities of each model
+    Returns:
+        A (num_samples,) np.ndarray of class indices
+    """
+    stacked = _stack(predictions)
+    # (num_samples, num_models * num_classes), model after model
+    concatenated = stacked.transpose(1, 0, 2).reshape(stacked.shape[1], -1)
+    return np.argmax(concatenated, axis=-1) % stacked.shape[2]
+
+
+def hard_confidence(predictions) -> np.ndarray:
+    """
+    Gives the probability behind each hard vote
+    Arguments:
+        predictions (list or np.ndarray): probabilities of each model
+    Returns:
+        A (num_samples,) np.ndarray of the highest probability given by any
+        model to any class
+    """
+    return _stack(predictions).max(axis=(0, 2))
+
+
+class VoteAccumulator:
+    """
+    Accumulates the votes of an ensemble as predictions stream in, model by
+    model and chunk by chunk, so that only one running sum of probabilities
+    is kept instead of every model's full predictions. Models must be added
+    in ensemble order for hard vote ties to match hard_vote
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights
+        self.size = 0
+        self.total = None
+        self.best = None
+        self.best_class = None
+        self.weight_sums = None
+
+    def _grow(self, size: int, num_classes: int) -> None:
+        """
+        Makes room for at least size samples
+        """
+        if self.total is None:
+            self.total = np.zeros((size, num_classes))
+            self.best = np.full(size, -np.inf)
+            self.best_class = np.zeros(size, dtype=np.int64)
+            self.weight_sums = np.zeros(size)
+        elif size > len(self.total):
+            extra = max(size, 2 * len(self.total)) - len(self.total)
+            self.total = np.concatenate([self.total,
+                                         np.zeros((extra, num_classes))])
+            self.best = np.concatenate([self.best, np.full(extra, -np.inf)])
+            self.best_class = np.concatenate(
+                [self.best_class, np.zeros(extra, dtype=np.int64)])
+            self.weight_sums = np.concatenate([self.weight_sums,
+                                               np.zeros(extra)])
+        self.size = max(self.size, size)
+
+    def add(self, predictions, model: int = 0, start: int = 0) -> None:
+        """
+        Adds the predictions of one model for a chunk of samples
+        Arguments:
+            predictions (np.ndarray): (chunk_size, num_classes) probabilities
+            model (int, default: 0): index of the model, for its weight
+            start (int, default: 0): index of the chunk's first sample
+        """
+        predictions = np.asarray(predictions)
+        end = start + len(predictions)
+        self._grow(end, predictions.shape[1])
+        weight = 1.0 if self.weights is None else self.weights[model]
+        self.total[start:end] += weight * predictions
+        self.weight_sums[start:end] += weight
+        confidence = predictions.max(axis=1)
+        better = confidence > self.best[start:end]
+        self.best[start:end][better] = confidence[better]
+        self.best_class[start:end][better] = predictions.argmax(
+            axis=1)[better]
+
+    def probabilities(self) -> np.ndarray:
+        """
+        Returns:
+            The (num_samples, num_classes) averaged probabilities
+        """
+        return (self.total[:self.size]
+                / self.weight_sums[:self.size, np.newaxis])
+
+    def soft_votes(self) -> np.ndarray:
+        """
+        Returns:
+            The (num_samples,) soft vote of every sample
+        """
+        return np.argmax(self.total[:self.size], axis=-1)
+
+    def hard_votes(self) -> np.ndarray:
+        """
+        Returns:
+            The (num_samples,) hard vote of every sample
+        """
+        return self.best_class[:self.size].copy()
+
+    def confidences(self) -> np.ndarray:
+        """
+        Returns:
+            The (num_samples,) probability behind every hard vote
+        """
+        return self.best[:self.size].copy()